@@ -0,0 +1,148 @@
+from rdflib import *
+from pathlib import Path
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+import NUVA_Utils
+from NUVA_Utils import (BaseURI,full_fname,core_fname,split_nuva,open_core,eval_code,eval_batch,lang_pivot,core_to_csv,
+                        query_cache)
+
+# Offline benchmark of the NUVA pipeline on synthetic data shaped like nuva_ivci.rdf.
+# Each scale point is generated in its own folder, then every stage is timed there.
+
+NUVS = Namespace("http://ivci.org/NUVA/nuvs#")
+NUVA = Namespace(BaseURI)
+code_names = ["CVX","ATC","CIS","CVC","CNK","PZN","DIN"]
+
+scale_points = [
+    {'vaccines': 300, 'valences': 60, 'depth': 3, 'langs': 2, 'systems': 3, 'codes': 80},
+    {'vaccines': 1500, 'valences': 200, 'depth': 4, 'langs': 4, 'systems': 4, 'codes': 400},
+    {'vaccines': 6000, 'valences': 600, 'depth': 5, 'langs': 8, 'systems': 6, 'codes': 1500},
+]
+
+def generate(vaccines=300,valences=60,depth=3,langs=2,systems=3,codes=80,seed=1,version="bench"):
+    # Writes nuva_ivci.rdf with the given number of vaccines, valences over depth levels,
+    # translated labels, and code systems with one mapped vaccine per code
+    rnd = random.Random(seed)
+    languages = ["fr","de","es","it","nl","pt","pl","sv","da","fi"][:langs]
+    g = Graph(store="Oxigraph")
+    g.add((URIRef("http://ivci.org/NUVA"),OWL.versionInfo,Literal(version)))
+    for c in ["Vaccine","Valence","Code","Disease"]:
+        g.add((NUVA[c],RDF.type,OWL.Class))
+
+    levels = [[] for _ in range(depth)]
+    for i in range(valences):
+        val = NUVA["VAL%04d" % i]
+        level = 0 if i < max(1,valences//(2*depth)) else rnd.randrange(depth)
+        while level > 0 and not levels[level-1]:
+            level -= 1
+        parent = NUVA.Valence if level == 0 else rnd.choice(levels[level-1])
+        levels[level].append(val)
+        g.add((val,RDFS.subClassOf,parent))
+        g.add((val,SKOS.notation,Literal("VAL%04d" % i)))
+        g.add((val,RDFS.label,Literal("Valence %d" % i,lang="en")))
+        for lang in languages:
+            g.add((val,RDFS.label,Literal("Valence %d (%s)" % (i,lang),lang=lang)))
+    upper = [val for level in levels[:max(1,depth//2)] for val in level]
+    every = [val for level in levels for val in level]
+
+    vacs = []
+    for i in range(vaccines):
+        vac = NUVA["VAC%04d" % i]
+        vacs.append(vac)
+        abstract = rnd.random() < 0.4
+        g.add((vac,RDFS.subClassOf,NUVA.Vaccine))
+        g.add((vac,SKOS.notation,Literal("VAC%04d" % i)))
+        g.add((vac,RDFS.label,Literal("Vaccine %d" % i,lang="en")))
+        g.add((vac,RDFS.comment,Literal("Comment %d" % i,lang="en")))
+        for lang in languages:
+            g.add((vac,RDFS.label,Literal("Vaccine %d (%s)" % (i,lang),lang=lang)))
+        g.add((vac,NUVS.isAbstract,Literal(abstract)))
+        pool = upper if abstract else every
+        for val in rnd.sample(pool,min(len(pool),rnd.randint(1,4))):
+            g.add((vac,NUVS.containsValence,val))
+
+    names = code_names[:systems]+["SYS%d" % i for i in range(len(code_names),systems)]
+    for name in names:
+        g.add((NUVA[name],RDFS.subClassOf,NUVA.Code))
+        g.add((NUVA[name],RDFS.label,Literal(name)))
+        for j in range(codes):
+            code = NUVA["%s-%04d" % (name,j)]
+            g.add((code,RDFS.subClassOf,NUVA[name]))
+            g.add((code,SKOS.notation,Literal("%04d" % j)))
+            g.add((code,RDFS.label,Literal("%s-%04d" % (name,j))))
+            g.add((rnd.choice(vacs),SKOS.exactMatch,code))
+
+    g.serialize(full_fname,format="ox-xml")
+    return names,len(g)
+
+def timed(timings,stage,function,*args,**kwargs):
+    start = time.perf_counter()
+    result = function(*args,**kwargs)
+    timings[stage] = time.perf_counter()-start
+    print (f"{stage}: {timings[stage]:.3f}s")
+    return result
+
+def bench(points=scale_points,engines=("matrix","index"),workers=None,folder="nuva_bench"):
+    results = {'date': time.strftime("%Y-%m-%d %H:%M:%S"), 'python': sys.version.split()[0],
+               'platform': platform.platform(), 'points': []}
+    home = os.getcwd()
+    saved_cache = NUVA_Utils.cache_dir
+    for n,params in enumerate(points):
+        point = Path(folder)/("point_%d" % n)
+        if point.exists(): shutil.rmtree(point)
+        point.mkdir(parents=True)
+        os.chdir(point)
+        # Snapshots of each point are kept apart from the real ones
+        NUVA_Utils.cache_dir = str(Path("cache").resolve())
+        version = "bench-%d" % n
+        try:
+            print (f"Scale point {params}")
+            timings = {}
+            systems,triples = timed(timings,"generate",generate,version=version,**params)
+            timed(timings,"split",split_nuva,workers)
+            g,store,key = timed(timings,"snapshot",open_core,core_fname,version)
+            g.close()
+            # Every stage starts from an empty query cache, so that each one pays for its queries
+            for engine in engines:
+                for fullset in (False,True):
+                    query_cache.clear()
+                    timed(timings,"eval_"+engine+("_full" if fullset else "_gen"),eval_code,systems[0],fullset,engine,version)
+            query_cache.clear()
+            timed(timings,"eval_batch",eval_batch,systems,(False,True),workers,"matrix",version)
+            timed(timings,"lang",lang_pivot,None,True,True)
+            timed(timings,"core_csv",core_to_csv)
+            results['points'].append({'params': params, 'triples': triples, 'timings': timings})
+        finally:
+            os.chdir(home)
+            NUVA_Utils.cache_dir = saved_cache
+
+    fname = str(Path(folder)/("nuva_bench_"+time.strftime("%Y%m%d_%H%M%S")+".json"))
+    print ("Create benchmark results "+fname)
+    with open(fname,'w',encoding="utf-8") as bench_file:
+        json.dump(results,bench_file,indent=2)
+    return fname
+
+def compare(old_fname,new_fname):
+    # Ratio new/old of every stage, for the scale points present in both runs
+    with open(old_fname,encoding="utf-8") as f: old = json.load(f)
+    with open(new_fname,encoding="utf-8") as f: new = json.load(f)
+    for old_point,new_point in zip(old['points'],new['points']):
+        if old_point['params'] != new_point['params']: continue
+        print (f"Scale point {new_point['params']}")
+        for stage,seconds in new_point['timings'].items():
+            if stage in old_point['timings']:
+                ratio = seconds/old_point['timings'][stage] if old_point['timings'][stage] else 0
+                print (f"  {stage:20} {old_point['timings'][stage]:8.3f}s -> {seconds:8.3f}s  x{ratio:.2f}")
+
+# Here the main program - Adapt the work directory to your environment
+
+if __name__ == "__main__":
+    os.chdir(str(Path.home())+"/Documents/NUVA")
+    bench()
+    #bench(scale_points[:2],engines=("matrix","index","sparql")) # The SPARQL q3 is slow on large points
+    #compare("nuva_bench/nuva_bench_<before>.json","nuva_bench/nuva_bench_<after>.json")
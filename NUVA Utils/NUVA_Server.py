@@ -0,0 +1,147 @@
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse,parse_qs
+from pathlib import Path
+import io
+import json
+import os
+import sys
+import threading
+import time
+from NUVA_Utils import BaseURI,core_fname,open_core,core_tables,parse_mappings,set_batch_tables,serve_job,record_dict
+
+# Local evaluation service: the core is loaded once, then every POST /eval evaluates one mapping.
+#   POST /eval?mode=full|gen&engine=matrix|index
+#        body: a mapping CSV (first column the code system, then NUVA), or
+#              JSON {"code": "CVX", "rows": [["CVX-07","VAC0189"], ...]}
+#   GET /status
+# Answers are JSON with the best and reverse codes, the metrics and the timings of the request.
+
+class Evaluator:
+    def __init__(self, workers=1, engine="matrix", version=None):
+        print ("Loading core graph")
+        g,store,key = open_core(core_fname,version)
+        self.tables = core_tables(g,key)
+        g.close()
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.served = 0
+        self.total = 0.0
+        # With a single worker requests are evaluated in the server threads, sharing the tables
+        set_batch_tables(self.tables)
+        self.executor = None
+        if workers != 1:
+            self.executor = ProcessPoolExecutor(max_workers=workers,initializer=set_batch_tables,initargs=(self.tables,))
+
+    def evaluate(self, code, rows, fullset, engine=None):
+        job = (code,rows,fullset,engine or self.engine)
+        start = time.perf_counter()
+        if self.executor is None:
+            result = serve_job(job)
+        else:
+            result = self.executor.submit(serve_job,job).result()
+        bestcodes,revcodes,metrics,warnings,elapsed = result
+        timings = {'queue': time.perf_counter()-start-elapsed, 'eval': elapsed}
+        return bestcodes,revcodes,metrics,warnings,timings
+
+    def done(self, elapsed):
+        with self.lock:
+            self.served += 1
+            self.total += elapsed
+
+    def status(self):
+        with self.lock:
+            return {'version': self.tables['version'], 'engine': self.engine,
+                    'systems': sorted(s[len(BaseURI):] for s in self.tables['systems']),
+                    'served': self.served, 'average': self.total/self.served if self.served else 0}
+
+class Handler(BaseHTTPRequestHandler):
+    evaluator = None
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/status":
+            self.answer(404,{'error': "Unknown path "+self.path})
+            return
+        self.answer(200,self.evaluator.status())
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path != "/eval":
+            self.answer(404,{'error': "Unknown path "+self.path})
+            return
+        params = parse_qs(url.query)
+        mode = params.get('mode',["full"])[0]
+        if mode not in ("full","gen"):
+            self.answer(400,{'error': "Unknown mode "+mode+", expected full or gen"})
+            return
+        fullset = mode == "full"
+        engine = params.get('engine',[None])[0]
+        if engine not in (None,"matrix","index"):
+            self.answer(400,{'error': "Unknown engine "+engine+", expected matrix or index"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            if length < 0:
+                raise ValueError("Invalid Content-Length "+str(length))
+            body = self.rfile.read(length).decode("utf-8-sig")
+            if self.headers.get('Content-Type','').startswith("application/json"):
+                request = json.loads(body)
+                code,rows = request['code'],[(extcode,nuva) for extcode,nuva in request['rows']]
+            else:
+                code,rows = parse_mappings(io.StringIO(body,newline=''))
+            if not isinstance(code,str):
+                raise ValueError("Invalid code system "+json.dumps(code))
+            for extcode,nuva in rows:
+                # External codes are <code system>-<value>, as in the refcode CSVs
+                if not isinstance(extcode,str) or not isinstance(nuva,str) or '-' not in extcode:
+                    raise ValueError("Invalid mapping row "+json.dumps([extcode,nuva]))
+        except (ValueError,KeyError,TypeError) as e:
+            self.answer(400,{'error': "Cannot read mappings: "+str(e)})
+            return
+        if BaseURI+code not in self.evaluator.tables['systems']:
+            self.answer(404,{'error': "Unknown CodeSystem "+code})
+            return
+        parsed = time.perf_counter()
+
+        bestcodes,revcodes,metrics,warnings,timings = self.evaluator.evaluate(code,rows,fullset,engine)
+        timings['parse'] = parsed-start
+        timings['total'] = time.perf_counter()-start
+        self.evaluator.done(timings['total'])
+        self.answer(200,{'code': code, 'mode': "full" if fullset else "gen", 'version': self.evaluator.tables['version'],
+                         'metrics': metrics,
+                         'best': {nuva_code:record_dict(best) for nuva_code,best in bestcodes.items()},
+                         'reverse': {extcode:record_dict(rev) for extcode,rev in revcodes.items()}, 'warnings': warnings,
+                         'timings': timings})
+        print (f"{code} {len(rows)} rows: total {timings['total']*1000:.1f} ms, eval {timings['eval']*1000:.1f} ms")
+
+    def answer(self, status, content):
+        data = json.dumps(content,ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header('Content-Type',"application/json; charset=utf-8")
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port=8765,workers=1,engine="matrix",version=None):
+    # Bound to localhost only
+    Handler.evaluator = Evaluator(workers,engine,version)
+    server = ThreadingHTTPServer(("127.0.0.1",port),Handler)
+    print (f"Serving NUVA {Handler.evaluator.tables['version']} on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if Handler.evaluator.executor is not None:
+        Handler.evaluator.executor.shutdown()
+
+# Here the main program - Adapt the work directory to your environment
+
+if __name__ == "__main__":
+    os.chdir(str(Path.home())+"/Documents/NUVA")
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8765, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -1,260 +1,1189 @@
 from rdflib import *
-from urllib.request import urlopen,urlretrieve
+from rdflib.store import Store
+from rdflib.query import Result
+from oxrdflib import OxigraphStore
+import pyoxigraph as ox
+from urllib.request import urlopen,Request
+from urllib.error import HTTPError
 from pathlib import Path
 import csv
+import io
 import json
 import os
+import sys
 import shutil
+import hashlib
+import sqlite3
 import math
+import time
+import zlib
+import uuid
+import unicodedata
+import bisect
+import ast
+import itertools
+import threading
+from collections import OrderedDict,deque
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 BaseURI="http://ivci.org/NUVA/"
 full_fname="nuva_ivci.rdf"
 core_fname ="nuva_core.ttl"
+split_summary_fname = "nuva_split_summary.csv"
+download_fname = "nuva_ivci.json"
+metrics_summary_fname = "nuva_metrics_summary.csv"
+bundle_fname = "nuva_bundle.nq"
+manifest_fname = "nuva_bundle.json"
+nuva_url = "https://ans.mesvaccins.net"
+chunk_size = 1 << 16
+core_graph = URIRef("urn:nuva:core")
+cache_dir = os.environ.get("NUVA_CACHE",str(Path.home())+"/.nuva")
 
-def get_nuva_version():
-    url="https://ans.mesvaccins.net/last_version.json"
+def get_nuva_version(base=nuva_url):
+    url=base+"/last_version.json"
     response=urlopen(url)
     data_json=json.loads(response.read())
     return (data_json['version'])
 
-def get_nuva(version):
-  print ("Retrieving NUVA version "+version)
-  fname1 = "nuva_ans.rdf";
-  urlretrieve("https://ans.mesvaccins.net/versions/"+version+"/nuva.rdf",fname1)
-
-  # Change base URL
-  f1= open(fname1,'r',encoding="utf-8")
-  f2= open(full_fname,'w',encoding="utf-8")
-  for line in f1:
-      relocated = line.replace("data.esante.gouv.fr","ivci.org")
-      f2.write(relocated.replace("NUVA#","NUVA/"))
-  f1.close()
-  f2.close()
-
-def split_nuva():
-    print ("Loading graph to split")
-    g = Graph()
-    g.parse(full_fname)
+def get_nuva(version,base=nuva_url,force=False):
+    # Stream nuva.rdf into nuva_ivci.rdf, relocating the base URI on the fly.
+    # The transfer may be gzipped, is conditional on the cached copy and resumes
+    # an interrupted download when the server supports ranges.
+    state = {}
+    if Path(download_fname).exists():
+        with open(download_fname,'r',encoding="utf-8") as state_file:
+            state = json.load(state_file)
+    if not force and state.get('version') == version and Path(full_fname).exists():
+        print ("NUVA version "+version+" is already retrieved")
+        return False
 
+    print ("Retrieving NUVA version "+version)
+    url = base+"/versions/"+version+"/nuva.rdf"
+    part_fname = full_fname+".part"
+    headers = {"Accept-Encoding": "gzip"}
+    offset = 0
+    partial = state.get('partial',{})
+    if partial.get('url') == url and Path(part_fname).exists():
+        offset = partial['offset']
+        headers = {"Accept-Encoding": "identity", "Range": f"bytes={offset}-"}
+        if partial.get('etag'): headers["If-Range"] = partial['etag']
+    elif state.get('url') == url and Path(full_fname).exists():
+        if state.get('etag'): headers["If-None-Match"] = state['etag']
+        if state.get('modified'): headers["If-Modified-Since"] = state['modified']
+
+    try:
+        response = urlopen(Request(url,headers=headers))
+    except HTTPError as error:
+        if error.code == 304:
+            print ("NUVA version "+version+" has not changed")
+            state['version'] = version
+            save_download_state(state)
+            return False
+        if error.code != 416: raise
+        # The partial download is unusable, start again
+        offset = 0
+        response = urlopen(Request(url,headers={"Accept-Encoding": "gzip"}))
+    if response.status != 206:
+        offset = 0
+    etag = response.headers.get("ETag") or (partial.get('etag') if offset else None)
+    modified = response.headers.get("Last-Modified")
+    gzipped = response.headers.get("Content-Encoding") == "gzip"
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS) if gzipped else None
+
+    out = open(part_fname,'r+b' if offset else 'wb')
+    if offset:
+        out.truncate(partial['size'])
+        out.seek(partial['size'])
+    pending = b''
+    consumed = offset
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                if response.length: raise ConnectionError("Connection closed before the end of "+url)
+                break
+            consumed += len(chunk)
+            pending += decompressor.decompress(chunk) if gzipped else chunk
+            # Only complete lines are relocated, so that patterns are never split
+            cut = pending.rfind(b'\n')+1
+            if cut:
+                out.write(relocate(pending[:cut]))
+                pending = pending[cut:]
+        if gzipped: pending += decompressor.flush()
+        out.write(relocate(pending))
+    except (OSError,zlib.error):
+        out.flush()
+        # Resuming is only possible at a line boundary of an uncompressed transfer
+        if not gzipped:
+            state['partial'] = {'url': url, 'etag': etag, 'offset': consumed-len(pending), 'size': out.tell()}
+            save_download_state(state)
+        out.close()
+        raise
+    out.close()
+    os.replace(part_fname,full_fname)
+    save_download_state({'version': version, 'url': url, 'etag': etag, 'modified': modified})
+    return True
+
+def relocate(data):
+    # Change base URL
+    return data.replace(b"data.esante.gouv.fr",b"ivci.org").replace(b"NUVA#",b"NUVA/")
+
+def save_download_state(state):
+    with open(download_fname,'w',encoding="utf-8") as state_file:
+        json.dump(state,state_file)
+
+def core_version(g):
+    return str(g.value(URIRef('http://ivci.org/NUVA'),OWL.versionInfo))
+
+def open_core(source=core_fname,version=None,cache=None):
+    # Open the on-disk Oxigraph snapshot of the core graph, keyed by the sha256 of the content
+    # of source, and return it with that key. The snapshot is built from source on first use,
+    # then opened read-only so that processes share it. A URL source is only transferred again
+    # when it has changed, and when it is unreachable the last snapshot of that URL is used.
+    cache = Path(cache or cache_dir)
+    cache.mkdir(parents=True,exist_ok=True)
+    data = None
+    pointer = None
+    if Path(source).exists():
+        with open(source,'rb') as source_file:
+            data = source_file.read()
+        key = hashlib.sha256(data).hexdigest()
+    else:
+        pointer = cache/("source_"+hashlib.sha256(str(source).encode("utf-8")).hexdigest()[:16]+".json")
+        state = {}
+        if pointer.exists():
+            with open(pointer,encoding="utf-8") as pointer_file:
+                state = json.load(pointer_file)
+        headers = {}
+        if state.get('key') and Path(str(cache/("core_"+state['key']))+".ready").exists():
+            if state.get('etag'): headers["If-None-Match"] = state['etag']
+            if state.get('modified'): headers["If-Modified-Since"] = state['modified']
+        try:
+            response = urlopen(Request(str(source),headers=headers))
+            data = response.read()
+            key = hashlib.sha256(data).hexdigest()
+            state = {'source': str(source), 'key': key,
+                     'etag': response.headers.get("ETag"), 'modified': response.headers.get("Last-Modified")}
+        except HTTPError as error:
+            if error.code != 304: raise
+            key = state['key']
+        except OSError:
+            if not state.get('key'): raise
+            print ("Cannot retrieve "+str(source)+", using its last core snapshot")
+            key = state['key']
+
+    snapshot = cache/("core_"+key)
+    if not Path(str(snapshot)+".ready").exists():
+        if data is None:
+            raise FileNotFoundError("Core snapshot of "+str(source)+" is missing from "+str(cache))
+        print ("Building core snapshot from "+str(source))
+        building = cache/("building_"+uuid.uuid4().hex)
+        store = ox.Store(str(building))
+        store.bulk_load(data,format=ox.RdfFormat.TURTLE,to_graph=ox.NamedNode(core_graph))
+        store.flush()
+        built = core_version(Graph(store=OxigraphStore(store=store),identifier=core_graph))
+        del store
+        if snapshot.exists():
+            shutil.rmtree(building)
+        else:
+            building.rename(snapshot)
+        Path(str(snapshot)+".ready").write_text(built)
+    if pointer is not None:
+        with open(pointer,'w',encoding="utf-8") as pointer_file:
+            json.dump(state,pointer_file)
+
+    store = open_stores.get(snapshot)
+    if store is None:
+        store = open_stores[snapshot] = ox.Store.read_only(str(snapshot))
+    g = Graph(store=OxigraphStore(store=store),identifier=core_graph)
+    g.bind("nuvs",Namespace("http://ivci.org/NUVA/nuvs#"))
+    g.bind("nuva",Namespace("http://ivci.org/NUVA/"))
+    if version is not None and core_version(g) != version:
+        raise ValueError("Core "+str(source)+" has version "+core_version(g)+", not "+version)
+    return g,store,key
+
+open_stores = {}
+working_stores = {}
+
+class Overlay(Graph):
+    # Throwaway named graph beside the core, holding the mappings of one evaluation.
+    # The core snapshot is read-only, so overlays live in an in-memory copy of it made once per
+    # process. Its queries see the core and this graph only, so that evaluations never see each other.
+    def __init__(self, core, store):
+        inner = working_stores.get(id(store))
+        if inner is None:
+            inner = working_stores[id(store)] = ox.Store()
+            inner.bulk_extend(store.quads_for_pattern(None,None,None,ox.NamedNode(core.identifier)))
+        super().__init__(store=OxigraphStore(store=inner),identifier=URIRef("urn:nuva:overlay:"+uuid.uuid4().hex))
+        self.core = core
+        self.inner = inner
+
+    def query(self, query_object, initBindings={}):
+        solutions = self.inner.query(query_object,
+                                     default_graph=[ox.NamedNode(self.core.identifier),ox.NamedNode(self.identifier)],
+                                     prefixes={prefix:str(namespace) for prefix,namespace in self.core.namespaces()},
+                                     substitutions={ox.Variable(var):to_ox(value) for var,value in initBindings.items()})
+        result = Result("SELECT")
+        result.vars = [Variable(v.value) for v in solutions.variables]
+        result.bindings = [{var:from_ox(value) for var,value in zip(result.vars,solution) if value is not None}
+                           for solution in solutions]
+        return result
+
+    def drop(self):
+        self.inner.remove_graph(ox.NamedNode(self.identifier))
+
+def to_ox(term):
+    if isinstance(term,URIRef):
+        return ox.NamedNode(term)
+    if isinstance(term,BNode):
+        return ox.BlankNode(term)
+    if term.language:
+        return ox.Literal(term,language=term.language)
+    return ox.Literal(term,datatype=ox.NamedNode(term.datatype or XSD.string))
+
+def from_ox(term):
+    if isinstance(term,ox.NamedNode):
+        return URIRef(term.value)
+    if isinstance(term,ox.BlankNode):
+        return BNode(term.value)
+    if term.language:
+        return Literal(term.value,lang=term.language)
+    return Literal(term.value,datatype=URIRef(term.datatype.value))
+
+class TripleSink(Store):
+    # Store that hands every parsed triple to a function instead of keeping it
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+
+    def add(self, triple, context, quoted=False):
+        self.handler(triple)
+
+    def addN(self, quads):
+        for s,p,o,c in quads:
+            self.handler((s,p,o))
+
+def stream_triples(fname, handler, format="ox-xml"):
+    # The native Oxigraph parser is much faster than the rdflib one for RDF/XML
+    Graph(store=TripleSink(handler)).parse(fname, format=format)
+
+def code_systems(fname):
+    # Pre-pass keeping only the hierarchy and labels, to classify external codes
     CodesParent=URIRef(BaseURI+"Code")
-    graph_codes = {}
-    graph_langs = {}
-
-    print("Initializing subgraphs for code systems")
-    Codes = g.subjects(RDFS.subClassOf,CodesParent)
-    for Code in Codes:
-        label=g.value(Code,RDFS.label)
-        graph_codes[label] = Graph(store="Oxigraph")
-
-    print("Initializing core graph")    
-    g_core= Graph(store="Oxigraph")
-    
-    for s,p,o in g:
-
-        # Extract languages
-        if (o.__class__.__name__== "Literal"):
-            lang = o.language
-            if (lang!="en" and lang!=None): 
-                if (not lang in graph_langs.keys()):
-                    graph_langs[lang] = Graph(store="Oxigraph");
-                graph_langs[lang].add((s,p,o))
-                continue
+    parents = {}
+    labels = {}
+    def keep(triple):
+        s,p,o = triple
+        if p == RDFS.subClassOf:
+            parents.setdefault(s,[]).append(o)
+        elif p == RDFS.label and s not in labels:
+            labels[s] = o
+    stream_triples(fname,keep)
 
-        # Extract properties of external codes
-        sparent=g.value(s,RDFS.subClassOf)
-        if (g.value(sparent,RDFS.subClassOf) == CodesParent):
-            system = g.value(sparent,RDFS.label)
-            graph_codes[system].add((s,p,o))
-            continue
+    systems = {s:str(labels.get(s,s.split('/')[-1])) for s in parents if CodesParent in parents[s]}
+    codes = {}
+    for s in parents:
+        for parent in parents[s]:
+            if parent in systems:
+                codes[s] = systems[parent]
+    return systems,codes
+
+def partition(triple,codes):
+    s,p,o = triple
+
+    # Extract languages
+    if isinstance(o,Literal):
+        lang = o.language
+        if (lang!="en" and lang!=None): 
+            return ("lang",lang)
+
+    # Extract properties of external codes
+    if s in codes:
+        return ("code",codes[s])
+
+    # Extract binding of external codes
+    if o in codes:
+        return ("code",codes[o])
+
+    # Otherwise the triple goes to core graph
+    return ("core",None)
+
+def partition_fname(kind,name):
+    if kind == "lang": return "nuva_lang_"+name+".ttl"
+    if kind == "code": return "nuva_refcode_"+name+".ttl"
+    return core_fname
+
+def split_job(kind,name,graph,g_core):
+    fname = partition_fname(kind,name)
+    if kind == "core":
+        return (fname,graph.serialize(format="ox-nt"),["nuvs","nuva"],None,None)
+    if kind == "lang":
+        return (fname,graph.serialize(format="ox-nt"),["nuva"],None,None)
+    labels = {s:g_core.value(s,RDFS.label) for s in graph.subjects(SKOS.exactMatch,None)}
+    return (fname,graph.serialize(format="ox-nt"),["nuva"],str(name),labels)
+
+class Terms:
+    # IRIs and literals interned to integer ids, shared by the triple tables of a split
+    __slots__ = ("ids","terms")
+    def __init__(self):
+        self.ids = {}
+        self.terms = []
+
+    def id(self, term):
+        i = self.ids.get(term)
+        if i is None:
+            i = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return i
+
+class Triples:
+    # Triples of one partition as three arrays of term ids
+    __slots__ = ("s","p","o")
+    def __init__(self):
+        self.s = array('i')
+        self.p = array('i')
+        self.o = array('i')
+
+    def add(self, s, p, o):
+        self.s.append(s)
+        self.p.append(p)
+        self.o.append(o)
+
+    def distinct(self):
+        return dict.fromkeys(zip(self.s,self.p,self.o))
+
+    def ntriples(self, nt):
+        return "".join(nt[s]+" "+nt[p]+" "+nt[o]+" .\n" for s,p,o in self.distinct())
+
+def table_job(kind,name,table,terms,nt,labels):
+    fname = partition_fname(kind,name)
+    if kind == "core":
+        return (fname,table.ntriples(nt),["nuvs","nuva"],None,None)
+    if kind == "lang":
+        return (fname,table.ntriples(nt),["nuva"],None,None)
+    exact = terms.ids.get(SKOS.exactMatch)
+    bound = {terms.terms[s] for s,p,o in table.distinct() if p == exact}
+    return (fname,table.ntriples(nt),["nuva"],str(name),{s:labels.get(s) for s in bound})
+
+def split_nuva(workers=None):
+    print ("Classifying external codes")
+    systems,codes = code_systems(full_fname)
+
+    # Terms are interned and partitions kept as arrays of ids until serialization
+    terms = Terms()
+    intern = terms.id
+    label = intern(RDFS.label)
+    version_info = intern(OWL.versionInfo)
+    tables = {}
+    labels = {}
+    versions = []
+
+    def route(triple):
+        part = partition(triple,codes)
+        s,p,o = triple
+        ids = (intern(s),intern(p),intern(o))
+        table = tables.get(part)
+        if table is None:
+            table = tables[part] = Triples()
+        table.add(*ids)
+        if part[0] == "core" and ids[1] == label:
+            labels.setdefault(s,o)
+        elif ids[1] == version_info:
+            versions.append(str(o))
+
+    print ("Splitting graph")
+    stream_triples(full_fname,route)
+    nt = [str(to_ox(term)) for term in terms.terms]
+    print (f"{len(nt)} distinct terms")
 
-        # Extract binding of external codes
-        oparent=g.value(o,RDFS.subClassOf)
-        if (g.value(oparent,RDFS.subClassOf) == CodesParent):
-            system = g.value(oparent,RDFS.label)
-            graph_codes[system].add((s,p,o))
+    core = tables.get(("core",None),Triples())
+    print(f"Core NUVA has {len(core.distinct())} statements.")
+    parts = [("core",None)]
+    jobs = [table_job("core",None,core,terms,nt,labels)]
+
+    for (kind,name),table in tables.items():
+        if kind == "lang":
+            print(f"There are {len(table.distinct())} statements for language {name}.")
+            parts.append((kind,name))
+            jobs.append(table_job(kind,name,table,terms,nt,labels))
+
+    for code in systems.values():
+        table = tables.get(("code",code),Triples())
+        print(f"There are {len(table.distinct())} statements for code {code}.")
+        parts.append(("code",code))
+        jobs.append(table_job("code",code,table,terms,nt,labels))
+    del tables,terms
+
+    summary = write_jobs(jobs,workers)
+    write_bundle([(kind,name,job[1]) for (kind,name),job in zip(parts,jobs)],versions[0] if versions else None)
+    return summary
+
+def write_jobs(jobs,workers):
+    # Turtle serialization dominates, so the files are written by a pool of processes
+    if workers == 1:
+        summary = list(map(write_split,jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            summary = list(executor.map(write_split,jobs))
+
+    summary_file = open(split_summary_fname,'w',encoding="utf-8",newline='')
+    writer = csv.writer(summary_file, delimiter=';')
+    writer.writerow(["File","Statements","Seconds"])
+    for fname,count,seconds in summary:
+        print(f"{fname}: {count} statements written in {seconds:.2f}s")
+        writer.writerow([fname,count,"{:.3f}".format(seconds)])
+    summary_file.close()
+    return summary
+
+def update_nuva(version,workers=None):
+    # Retrieve a new NUVA version and patch only the split outputs it changes
+    prev_fname = "nuva_ivci_prev.rdf"
+    if not Path(full_fname).exists() or not Path(core_fname).exists():
+        get_nuva(version)
+        return split_nuva(workers)
+    shutil.copyfile(full_fname,prev_fname)
+    if not get_nuva(version):
+        return []
+    return delta_split(prev_fname,workers)
+
+def delta_split(prev_fname,workers=None):
+    print ("Classifying external codes")
+    old_systems,old_codes = code_systems(prev_fname)
+    systems,codes = code_systems(full_fname)
+    if old_codes != codes:
+        print ("Code systems have changed, splitting the whole graph")
+        return split_nuva(workers)
+
+    print ("Computing triple changes")
+    old = set()
+    stream_triples(prev_fname,old.add)
+    new = set()
+    stream_triples(full_fname,new.add)
+    added = new - old
+    removed = old - new
+    del old,new
+
+    ontology = URIRef('http://ivci.org/NUVA')
+    versions = {"from": None, "to": None}
+    changes = {}
+    for key,triples in (("removed",removed),("added",added)):
+        for triple in triples:
+            changes.setdefault(partition(triple,codes),{"added":[],"removed":[]})[key].append(triple)
+            if triple[0] == ontology and triple[1] == OWL.versionInfo:
+                versions["from" if key == "removed" else "to"] = str(triple[2])
+    print (f"{len(added)} statements added, {len(removed)} statements removed")
+
+    print ("Patching split outputs")
+    graphs = {}
+    for kind,name in set(changes) | {("core",None)} | {("code",system) for system in systems.values()}:
+        graph = Graph(store="Oxigraph")
+        fname = partition_fname(kind,name)
+        if Path(fname).exists():
+            graph.parse(fname,format="ox-turtle")
+        for triple in changes.get((kind,name),{}).get("removed",[]):
+            graph.remove(triple)
+        for triple in changes.get((kind,name),{}).get("added",[]):
+            graph.add(triple)
+        graphs[(kind,name)] = graph
+    g_core = graphs[("core",None)]
+
+    # Refcode CSV files carry the core labels of the bound vaccines
+    relabelled = {s for (s,p,o) in changes.get(("core",None),{}).get("added",[])+changes.get(("core",None),{}).get("removed",[])
+                  if p == RDFS.label}
+    affected = set(changes)
+    for system in systems.values():
+        if set(graphs[("code",system)].subjects(SKOS.exactMatch,None)) & relabelled:
+            affected.add(("code",system))
+
+    jobs = []
+    patched = {}
+    for kind,name in sorted(affected, key=lambda part: (part[0],str(part[1]))):
+        if kind == "lang" and len(graphs[(kind,name)]) == 0:
+            print ("Removing "+partition_fname(kind,name))
+            Path(partition_fname(kind,name)).unlink(missing_ok=True)
+            patched[(kind,name)] = None
             continue
+        jobs.append(split_job(kind,name,graphs[(kind,name)],g_core))
+        patched[(kind,name)] = jobs[-1][1]
+    summary = write_jobs(jobs,workers)
 
-        # Otherwise the triple goes to core graph
-        g_core.add((s,p,o))
+    # Partitions left unchanged are copied from the previous bundle as they are
+    if Path(manifest_fname).exists():
+        with open(manifest_fname,encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        bundle_file = open(manifest['bundle'],'rb')
+        parts = []
+        for part in manifest['partitions'].values():
+            kind,name = part['kind'],part['name']
+            if (kind,name) in patched:
+                data = patched.pop((kind,name))
+                if data is not None: parts.append((kind,name,data))
+            else:
+                bundle_file.seek(part['offset'])
+                parts.append((kind,name,bundle_file.read(part['length'])))
+        bundle_file.close()
+        parts += [(kind,name,data) for (kind,name),data in patched.items() if data is not None]
+        write_bundle(parts,versions["to"] or manifest['version'])
 
-    NUVS = Namespace("http://ivci.org/NUVA/nuvs#")
-    NUVA = Namespace("http://ivci.org/NUVA/") 
-    g_core.bind("nuvs",NUVS)
-    g_core.bind("nuva",NUVA)
+    changelog = {"from": versions["from"], "to": versions["to"],
+                 "added": len(added), "removed": len(removed),
+                 "files": {partition_fname(kind,name): {"added": len(part["added"]), "removed": len(part["removed"])}
+                           for (kind,name),part in changes.items()},
+                 "statements": {key: sorted(" ".join(str(to_ox(term)) for term in triple)+" ." for triple in triples)
+                                for key,triples in (("added",added),("removed",removed))}}
+    changelog_fname = "nuva_changes_"+str(versions["from"])+"_"+str(versions["to"])+".json"
+    print ("Create changelog "+changelog_fname)
+    changelog_file = open(changelog_fname,'w',encoding="utf-8")
+    json.dump(changelog,changelog_file,indent=1,ensure_ascii=False)
+    changelog_file.close()
+    return summary
 
-    print(f"Core NUVA has {len(g_core)} statements.")
-    g_core.serialize(destination=core_fname)
+def partition_key(kind,name):
+    return kind if name is None else kind+":"+name
 
-    for lang in graph_langs:
-        print(f"There are {len(graph_langs[lang])} statements for language {lang}.")
-        fname = "nuva_lang_"+lang+".ttl"
-        graph_langs[lang].bind("nuva",NUVA)
-        graph_langs[lang].serialize(destination=fname)
+def write_bundle(parts,version):
+    # All partitions in one N-Quads file, each one a contiguous named graph whose byte range is
+    # kept in the manifest, so that a partition is read without scanning the others.
+    # Parts are (kind, name, data) with N-Triples text, or N-Quads bytes of a previous bundle.
+    manifest = {'version': version, 'bundle': bundle_fname, 'partitions': {}}
+    tmp_fname = bundle_fname+".tmp"
+    bundle_file = open(tmp_fname,'wb')
+    offset = 0
+    for kind,name,data in parts:
+        key = partition_key(kind,name)
+        assert key not in manifest['partitions'], "Partition "+key+" written twice in "+bundle_fname
+        graph = "urn:nuva:"+key
+        if isinstance(data,str):
+            data = data.replace(" .\n"," <"+graph+"> .\n").encode("utf-8")
+        bundle_file.write(data)
+        manifest['partitions'][key] = {'kind': kind, 'name': name, 'graph': graph, 'file': partition_fname(kind,name),
+                                       'offset': offset, 'length': len(data), 'statements': data.count(b"\n")}
+        offset += len(data)
+    bundle_file.close()
+    os.replace(tmp_fname,bundle_fname)
+    with open(manifest_fname,'w',encoding="utf-8") as manifest_file:
+        json.dump(manifest,manifest_file,indent=1)
+    print (f"Create bundle {bundle_fname}: {len(manifest['partitions'])} partitions, {offset} bytes")
+    return manifest
 
-    for code in graph_codes:
-        csv_fname = "nuva_refcode_"+code+".csv"
-        print(f"There are {len(graph_codes[code])} statements for code {code}.")
-        fname = "nuva_refcode_"+code+".ttl"
-        graph_codes[code].bind("nuva",NUVA)
-        graph_codes[code].serialize(destination=fname)
+def load_partitions(parts=("core",),manifest=manifest_fname):
+    # Dataset of the requested partitions only, e.g. ["core","lang:fr","code:CVX"].
+    # Each partition stays a named graph, and triples and queries see their union.
+    with open(manifest,encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    store = ox.Store()
+    bundle_file = open(manifest['bundle'],'rb')
+    for key in parts:
+        if key not in manifest['partitions']:
+            bundle_file.close()
+            raise KeyError("Unknown partition "+key+" in "+manifest['bundle'])
+        part = manifest['partitions'][key]
+        bundle_file.seek(part['offset'])
+        store.bulk_load(bundle_file.read(part['length']),format=ox.RdfFormat.N_QUADS)
+    bundle_file.close()
+    g = Dataset(store=OxigraphStore(store=store),default_union=True)
+    g.bind("nuvs",Namespace("http://ivci.org/NUVA/nuvs#"))
+    g.bind("nuva",Namespace(BaseURI))
+    return g
 
+def write_split(job):
+    # Serialize one output of split_nuva, with the refcode CSV for code systems
+    start = time.perf_counter()
+    fname,data,prefixes,code,labels = job
+    namespaces = {"nuvs": Namespace("http://ivci.org/NUVA/nuvs#"), "nuva": Namespace("http://ivci.org/NUVA/")}
+    g = Graph(store="Oxigraph")
+    g.parse(data=data,format="ox-nt")
+    for prefix in prefixes:
+        g.bind(prefix,namespaces[prefix])
+    g.serialize(destination=fname)
+
+    if code is not None:
+        csv_fname = "nuva_refcode_"+code+".csv"
         csv_file = open(csv_fname,'w',encoding="utf-8-sig",newline='')
         writer = csv.writer(csv_file, delimiter=';')
         writer.writerow([code,"NUVA","Label"])
+        for s,o in sorted(g.subject_objects(SKOS.exactMatch), key=lambda so: (so[1],so[0])):
+            writer.writerow([o.split('/')[-1],s.split('/')[-1],labels[s]])
+        csv_file.close()
+        fname += " + "+csv_fname
+    return (fname,len(g),time.perf_counter()-start)
 
-        for s,p,o in graph_codes[code].triples((None,SKOS.exactMatch,None)):
-            label = g_core.value(s,RDFS.label)
-            writer.writerow([o.split('/')[-1],s.split('/')[-1],label])
-        csv_file.close
-
-def core_to_csv():
+def core_to_csv(columnar=True):
+    # Normalized tables of the core in one projection, as CSV and as .npy columns
     core_fname = "nuva_core.ttl"
     csv_fname = "nuva_core.csv"
     g_core=Graph(store="Oxigraph")
     g_core.parse (core_fname)
+    tables = core_projection(g_core)
+
     csv_file = open(csv_fname,'w',encoding="utf-8",newline='')
     writer = csv.writer(csv_file, delimiter=';')
     writer.writerow(["NUVA","Label","Comment"])
-
-    VaccinesParent=URIRef(BaseURI+"Vaccine")
-        
-    for vaccine in g_core.subjects(RDFS.subClassOf,VaccinesParent):
-        writer.writerow([str(g_core.value(vaccine,SKOS.notation)), str(g_core.value(vaccine,RDFS.label)), str(g_core.value(vaccine,RDFS.comment))])
+    writer.writerows(row[:3] for row in tables['vaccines'][1])
     csv_file.close()
 
+    for table,(header,rows) in tables.items():
+        csv_fname = "nuva_"+table+".csv"
+        print ("Create table "+csv_fname)
+        csv_file = open(csv_fname,'w',encoding="utf-8",newline='')
+        writer = csv.writer(csv_file, delimiter=';')
+        writer.writerow(header)
+        writer.writerows(rows)
+        csv_file.close()
+
+    if columnar:
+        if np is None:
+            print ("NumPy is not available, no columnar export")
+        else:
+            write_columns(tables)
+    return tables
+
+def core_projection(g):
+    q="""
+    SELECT ?kind ?id ?a ?b ?c WHERE {
+      {
+        ?x rdfs:subClassOf nuva:Vaccine ; skos:notation ?id .
+        OPTIONAL { ?x rdfs:label ?a filter(lang(?a)='en'||lang(?a)='') }
+        OPTIONAL { ?x rdfs:comment ?b filter(lang(?b)='en'||lang(?b)='') }
+        OPTIONAL { ?x nuvs:isAbstract ?c }
+        BIND("vaccine" AS ?kind)
+      } UNION {
+        ?x rdfs:subClassOf+ nuva:Valence ; rdfs:subClassOf ?parent ; skos:notation ?id .
+        OPTIONAL { ?x rdfs:label ?a filter(lang(?a)='en'||lang(?a)='') }
+        OPTIONAL { ?parent skos:notation ?b }
+        BIND("valence" AS ?kind)
+      } UNION {
+        ?x rdfs:subClassOf nuva:Vaccine ; skos:notation ?id ; nuvs:containsValence ?val .
+        ?val skos:notation ?a .
+        BIND("contains" AS ?kind)
+      }
+    }
+    """
+    vaccines = {}
+    valences = {}
+    containment = set()
+    for row in g.query(q,initNs={"nuva":Namespace(BaseURI),"nuvs":Namespace("http://ivci.org/NUVA/nuvs#")}):
+        values = tuple("" if v is None else str(v) for v in (row.id,row.a,row.b,row.c))
+        if str(row.kind) == "vaccine":
+            vaccines.setdefault(values[0],values)
+        elif str(row.kind) == "valence":
+            valences.setdefault(values[:3],values[:3])
+        else:
+            containment.add(values[:2])
+
+    bindings = []
+    for fname in sorted(Path(".").glob("nuva_refcode_*.csv")):
+        code,rows = read_mappings(fname)
+        bindings += [(code,extcode,nuva) for extcode,nuva in rows]
+
+    return {'vaccines': (["NUVA","Label","Comment","IsAbstract"],sorted(vaccines.values())),
+            'valences': (["NUVA","Label","Parent"],sorted(valences.values())),
+            'containment': (["Vaccine","Valence"],sorted(containment)),
+            'bindings': (["Code","External","NUVA"],sorted(bindings))}
+
+def write_columns(tables,folder="nuva_columns"):
+    # Every string column becomes int32 ids into one shared string table, flags become booleans
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    strings = sorted({value for header,rows in tables.values() for row in rows for value in row})
+    ids = {value:i for i,value in enumerate(strings)}
+    np.save(folder+"/strings.npy",np.array(strings))
+    for table,(header,rows) in tables.items():
+        for i,column in enumerate(header):
+            if column.startswith("Is"):
+                data = np.array([row[i] == "true" for row in rows],dtype=bool)
+            else:
+                data = np.array([ids[row[i]] for row in rows],dtype=np.int32)
+            np.save(folder+"/"+table+"."+column+".npy",data)
+    print (f"Create columnar tables in {folder} ({len(strings)} strings)")
+
+def read_columns(table,folder="nuva_columns"):
+    strings = np.load(folder+"/strings.npy")
+    columns = {}
+    for fname in sorted(Path(folder).glob(table+".*.npy")):
+        data = np.load(fname)
+        columns[fname.stem.split('.')[1]] = data if data.dtype == bool else strings[data]
+    return columns
+
+nuva_schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE vaccines (notation TEXT PRIMARY KEY, label TEXT, comment TEXT, abstract INTEGER) WITHOUT ROWID;
+CREATE TABLE valences (notation TEXT PRIMARY KEY, label TEXT) WITHOUT ROWID;
+CREATE TABLE vaccine_valences (vaccine TEXT, valence TEXT, PRIMARY KEY (vaccine,valence)) WITHOUT ROWID;
+CREATE TABLE valence_closure (valence TEXT, ancestor TEXT, depth INTEGER, PRIMARY KEY (valence,ancestor)) WITHOUT ROWID;
+CREATE TABLE systems (name TEXT PRIMARY KEY, uri TEXT) WITHOUT ROWID;
+CREATE TABLE codes (code TEXT PRIMARY KEY, system TEXT, notation TEXT, label TEXT) WITHOUT ROWID;
+CREATE TABLE bindings (concept TEXT, code TEXT, PRIMARY KEY (concept,code)) WITHOUT ROWID;
+CREATE TABLE labels (concept TEXT, lang TEXT, property TEXT, value TEXT, PRIMARY KEY (concept,lang,property,value)) WITHOUT ROWID;
+"""
+# Reverse lookups, created once the rows are in
+nuva_indexes = """
+CREATE INDEX vaccine_valences_valence ON vaccine_valences (valence,vaccine);
+CREATE INDEX valence_closure_ancestor ON valence_closure (ancestor,valence);
+CREATE INDEX codes_system ON codes (system,notation);
+CREATE INDEX bindings_code ON bindings (code,concept);
+CREATE INDEX labels_lang ON labels (lang,property);
+"""
+
+def split_to_sqlite(db_fname="nuva.db"):
+    # Normalized SQLite database of the split files, keyed on NUVA notations and external codes:
+    # the core, the bindings of every nuva_refcode_*.ttl and the labels of every nuva_lang_*.ttl
+    NUVS = Namespace("http://ivci.org/NUVA/nuvs#")
+    notations = {}
+    parents = {}
+    texts = []
+    abstract = {}
+    contains = []
+    matches = []
+    version = []
+    def keep(lang):
+        def keep_triple(triple):
+            s,p,o = triple
+            if p == SKOS.notation:
+                notations.setdefault(s,str(o))
+            elif p == RDFS.subClassOf:
+                parents.setdefault(s,[]).append(o)
+            elif p in (RDFS.label,RDFS.comment) and isinstance(o,Literal):
+                texts.append((s,o.language or lang,"label" if p == RDFS.label else "comment",str(o)))
+            elif p == NUVS.isAbstract:
+                abstract[s] = str(o) == "true"
+            elif p == NUVS.containsValence:
+                contains.append((s,o))
+            elif p == SKOS.exactMatch:
+                matches.append((s,o))
+            elif p == OWL.versionInfo:
+                version.append(str(o))
+        return keep_triple
+    print ("Reading "+core_fname)
+    stream_triples(core_fname,keep("en"),"ox-turtle")
+    for fname in sorted(Path(".").glob("nuva_refcode_*.ttl"))+sorted(Path(".").glob("nuva_lang_*.ttl")):
+        print ("Reading "+fname.name)
+        stream_triples(str(fname),keep(""),"ox-turtle")
+
+    VaccinesParent = URIRef(BaseURI+"Vaccine")
+    ValencesParent = URIRef(BaseURI+"Valence")
+    CodesParent = URIRef(BaseURI+"Code")
+    english = {}
+    for s,lang,prop,value in texts:
+        if lang in ("en",""): english.setdefault((s,prop),value)
+
+    kinds = {}
+    def is_valence(node):
+        if node not in kinds:
+            kinds[node] = False
+            kinds[node] = any(parent == ValencesParent or is_valence(parent) for parent in parents.get(node,[]))
+        return kinds[node]
+    vaccines = [s for s in parents if VaccinesParent in parents[s] and s in notations]
+    valences = {s for s in parents if s in notations and is_valence(s)}
+    systems = {s:english.get((s,"label"),s.split('/')[-1]) for s in parents if CodesParent in parents[s]}
+    codes = {s:parent for s in parents for parent in parents[s] if parent in systems}
+
+    # Every valence with itself and all its ancestors, at their shortest distance
+    closure = []
+    for val in valences:
+        depth = {val: 0}
+        level = [val]
+        while level:
+            distance = depth[level[0]]+1
+            level = [parent for node in level for parent in parents.get(node,[]) if parent in valences and parent not in depth]
+            for parent in level: depth.setdefault(parent,distance)
+        closure += [(notations[val],notations[ancestor],d) for ancestor,d in depth.items()]
+
+    concepts = set(vaccines) | valences
+    # Built aside then renamed, so that readers never see a partial database
+    tmp_fname = db_fname+".tmp"
+    if Path(tmp_fname).exists(): os.remove(tmp_fname)
+    con = sqlite3.connect(tmp_fname)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+    con.executescript(nuva_schema)
+    with con:
+        con.executemany("INSERT INTO meta VALUES (?,?)",[("version",version[0] if version else ""),("created",time.strftime("%Y-%m-%d %H:%M:%S"))])
+        con.executemany("INSERT OR IGNORE INTO vaccines VALUES (?,?,?,?)",
+                        ((notations[s],english.get((s,"label")),english.get((s,"comment")),int(abstract.get(s,False))) for s in vaccines))
+        con.executemany("INSERT OR IGNORE INTO valences VALUES (?,?)",((notations[s],english.get((s,"label"))) for s in valences))
+        con.executemany("INSERT OR IGNORE INTO vaccine_valences VALUES (?,?)",
+                        ((notations[vac],notations[val]) for vac,val in contains if vac in notations and val in notations))
+        con.executemany("INSERT INTO valence_closure VALUES (?,?,?)",closure)
+        con.executemany("INSERT OR IGNORE INTO systems VALUES (?,?)",((str(label),str(s)) for s,label in systems.items()))
+        con.executemany("INSERT OR IGNORE INTO codes VALUES (?,?,?,?)",
+                        ((s[len(BaseURI):],str(systems[system]),notations.get(s),english.get((s,"label"))) for s,system in codes.items()))
+        con.executemany("INSERT OR IGNORE INTO bindings VALUES (?,?)",
+                        ((notations[s],o[len(BaseURI):]) for s,o in matches if s in notations and o in codes))
+        con.executemany("INSERT OR IGNORE INTO labels VALUES (?,?,?,?)",
+                        ((notations[s],lang,prop,value) for s,lang,prop,value in texts if s in concepts))
+    con.executescript(nuva_indexes)
+    con.execute("ANALYZE")
+    counts = {table:con.execute("SELECT count(*) FROM "+table).fetchone()[0]
+              for table in ("vaccines","valences","vaccine_valences","valence_closure","systems","codes","bindings","labels")}
+    con.close()
+    os.replace(tmp_fname,db_fname)
+    print ("Create database "+db_fname+": "+", ".join(f"{n} {table}" for table,n in counts.items()))
+    return counts
+
 def lang_table(l1,l2):
-    fname1 = "nuva_lang_"+l1+".ttl"
-    fname2 = "nuva_lang_"+l2+".ttl"
-    csv_fname = "nuva_lang_"+l1+"_"+l2+".csv"
+    lang_pivot([l1,l2],pivot=False,pairs=True)
 
-    g1= Graph(store="Oxigraph")
-    g1.parse (fname1)
-    g2 = Graph(store="Oxigraph")
-    g2.parse (fname2)
+def lang_pivot(langs=None,pivot=True,pairs=False):
+    # All language files joined on (subject, predicate) with the English labels of the core,
+    # written as one wide CSV and/or as the pairwise tables of lang_table.
+    # Every value is kept: several values of a cell are joined with " | " in the wide CSV, and
+    # the pairwise tables have one row per value of the first language, as lang_table had.
+    if langs is None:
+        langs = sorted(fname.stem[len("nuva_lang_"):] for fname in Path(".").glob("nuva_lang_*.ttl"))
+    notations = {}
+    table = {}
 
-    csv_file = open(csv_fname,'w',encoding="utf-8-sig",newline='')
-    writer = csv.writer(csv_file, delimiter=';')
-    writer.writerow([l1,l2])
+    def core_value(triple):
+        s,p,o = triple
+        if p == SKOS.notation:
+            notations.setdefault(s,str(o))
+        elif isinstance(o,Literal) and o.language == "en":
+            table.setdefault((s,p),{}).setdefault("en",[]).append(str(o))
+    stream_triples(core_fname,core_value,"ox-turtle")
 
-    for (s,p,o1) in g1:
-        o2 = g2.value(s,p,None)
-        writer.writerow([o1,o2])
-            
-def eval_code(code,fullset):
-    if fullset:
-        suffix="_full"
-    else:
-        suffix="_gen"
-    rev_fname = "nuva_reverse_"+code+suffix+".csv"
-    best_fname="nuva_best_"+code+suffix+".csv"
-    metrics_fname = "nuva_metrics_"+code+suffix+".txt"
-    csv_fname = "nuva_refcode_"+code+".csv"
-    print ("Loading core graph")
-    g = Graph(store="Oxigraph")
-    g.parse(core_fname)
+    for lang in langs:
+        def lang_value(triple):
+            s,p,o = triple
+            table.setdefault((s,p),{}).setdefault(lang,[]).append(str(o))
+        stream_triples("nuva_lang_"+lang+".ttl",lang_value,"ox-turtle")
 
+    def key(sp):
+        s,p = sp
+        return (notations.get(s,s.split('/')[-1]),p.split('#')[-1].split('/')[-1])
+    rows = sorted((key(sp),values) for sp,values in table.items())
 
-    print ("Loading code graph")
+    if pivot:
+        csv_fname = "nuva_lang.csv"
+        print ("Create language table "+csv_fname)
+        csv_file = open(csv_fname,'w',encoding="utf-8-sig",newline='')
+        writer = csv.writer(csv_file, delimiter=';')
+        writer.writerow(["NUVA","Property","en"]+langs)
+        for (notation,prop),values in rows:
+            writer.writerow([notation,prop]+[" | ".join(values.get(lang,[])) for lang in ["en"]+langs])
+        csv_file.close()
 
-    csv_file = open(csv_fname,'r',encoding="utf-8-sig",newline='')
-    reader = csv.DictReader(csv_file,delimiter=';')
-    code = reader.fieldnames[0]
+    if pairs:
+        for i,l1 in enumerate(langs):
+            for l2 in langs[i+1:]:
+                csv_fname = "nuva_lang_"+l1+"_"+l2+".csv"
+                print ("Create language table "+csv_fname)
+                csv_file = open(csv_fname,'w',encoding="utf-8-sig",newline='')
+                writer = csv.writer(csv_file, delimiter=';')
+                writer.writerow([l1,l2])
+                writer.writerows([value,values.get(l2,[""])[0]] for _,values in rows if l1 in values for value in values[l1])
+                csv_file.close()
 
-    codeParent=URIRef(BaseURI+code)
-    if ((codeParent,None,None) not in g):
-        print ("Unknown CodeSystem "+code)
-        # Ajouter ici la création du code parent
+def fold(text):
+    # Lower case without accents nor punctuation, for label search
+    text = unicodedata.normalize("NFKD",text.casefold())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+def trigrams(text):
+    padded = "  "+text+" "
+    return {padded[i:i+3] for i in range(len(padded)-2)}
+
+class StringArray:
+    # Sorted strings stored as one UTF-8 buffer and offsets, searchable with bisect
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode("utf-8")
+
+    def prefixed(self, prefix):
+        return bisect.bisect_left(self,prefix),bisect.bisect_left(self,prefix+"\U0010ffff")
+
+def save_strings(fname,strings):
+    data = [string.encode("utf-8") for string in strings]
+    np.save(fname+".blob.npy",np.frombuffer(b"".join(data),dtype=np.uint8))
+    np.save(fname+".offsets.npy",np.cumsum([0]+[len(d) for d in data],dtype=np.int64))
+
+def load_strings(fname):
+    return StringArray(mapped(fname+".blob.npy"),mapped(fname+".offsets.npy"))
+
+def mapped(fname):
+    # Plain array over the memory map, as np.memmap slicing is slow for many small reads
+    return np.asarray(np.load(fname,mmap_mode='r'))
+
+def distinct(values):
+    values = np.sort(values)
+    return values[np.concatenate(([True],values[1:] != values[:-1]))] if len(values) else values
+
+def build_label_index(folder="nuva_search"):
+    # Vaccine and valence labels of the core and of every nuva_lang_*.ttl, folded and indexed
+    # by word prefix and by trigram, written as .npy arrays to be memory-mapped by LabelIndex
+    if np is None:
+        print ("NumPy is not available, no label index")
         return
+    notations = {}
+    parents = {}
+    labels = []
+    def keep(lang):
+        def keep_triple(triple):
+            s,p,o = triple
+            if p == SKOS.notation:
+                notations.setdefault(s,str(o))
+            elif p == RDFS.subClassOf:
+                parents.setdefault(s,[]).append(o)
+            elif p in (RDFS.label,SKOS.prefLabel,SKOS.altLabel) and isinstance(o,Literal):
+                labels.append((s,o.language or lang,str(o)))
+        return keep_triple
+    stream_triples(core_fname,keep("en"),"ox-turtle")
+    langs = sorted(fname.stem[len("nuva_lang_"):] for fname in Path(".").glob("nuva_lang_*.ttl"))
+    for lang in langs:
+        stream_triples("nuva_lang_"+lang+".ttl",keep(lang),"ox-turtle")
 
-    for row in reader:
-        codeURI=URIRef(BaseURI+row[code])
-        nuvaURI=URIRef(BaseURI+row["NUVA"])
-        if ((nuvaURI,None,None) not in g):
-            print ("Mapping to unknown NUVA code "+row["NUVA"])            
+    roots = {URIRef(BaseURI+"Vaccine"),URIRef(BaseURI+"Valence")}
+    kinds = {}
+    def searchable(node):
+        if node not in kinds:
+            kinds[node] = False
+            kinds[node] = any(parent in roots or searchable(parent) for parent in parents.get(node,[]))
+        return kinds[node]
 
-        codeValue=row[code].rsplit('-')[1]
+    codes = sorted({notations[s] for s,lang,label in labels if s in notations and searchable(s)})
+    code_ids = {code:i for i,code in enumerate(codes)}
+    lang_ids = {}
+    entries = sorted({(fold(label),code_ids[notations[s]],lang_ids.setdefault(lang,len(lang_ids)))
+                      for s,lang,label in labels if s in notations and searchable(s) and fold(label)})
 
-        g.add((nuvaURI,SKOS.exactMatch,codeURI))
-        g.add((codeURI,RDFS.Class,OWL.Class))
-        g.add((codeURI,RDFS.subClassOf,codeParent))
-        g.add((codeURI,SKOS.notation,Literal(codeValue)))
-        g.add((codeURI,RDFS.label,Literal(row[code])))
-        
-    csv_file.close 
+    words = sorted((word,i) for i,(text,code,lang) in enumerate(entries) for word in set(text.split()))
+    grams = {}
+    for i,(text,code,lang) in enumerate(entries):
+        for gram in trigrams(text):
+            grams.setdefault(gram,[]).append(i)
+    gram_keys = sorted(grams)
 
-    #if os.path.isfile(work_fname): g.parse(work_fname)
-    #else: g.parse(ref_fname)
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    save_strings(folder+"/labels",[text for text,code,lang in entries])
+    np.save(folder+"/label_code.npy",np.array([code for text,code,lang in entries],dtype=np.int32))
+    np.save(folder+"/label_lang.npy",np.array([lang for text,code,lang in entries],dtype=np.int16))
+    np.save(folder+"/label_grams.npy",np.array([len(trigrams(text)) for text,code,lang in entries],dtype=np.int32))
+    np.save(folder+"/label_length.npy",np.array([len(text) for text,code,lang in entries],dtype=np.int32))
+    save_strings(folder+"/words",[word for word,i in words])
+    np.save(folder+"/word_label.npy",np.array([i for word,i in words],dtype=np.int32))
+    save_strings(folder+"/grams",gram_keys)
+    np.save(folder+"/gram_offsets.npy",np.cumsum([0]+[len(grams[gram]) for gram in gram_keys],dtype=np.int64))
+    np.save(folder+"/gram_label.npy",np.array([i for gram in gram_keys for i in grams[gram]],dtype=np.int32))
+    with open(folder+"/search.json",'w',encoding="utf-8") as meta_file:
+        json.dump({'codes': codes, 'langs': sorted(lang_ids,key=lang_ids.get)},meta_file)
+    print (f"Create label index in {folder}: {len(entries)} labels of {len(codes)} concepts in {len(lang_ids)} languages")
 
-    print ("Retrieve the list of NUVA codes")
-    q1="""
-    SELECT ?vacnot ?label ?abstract WHERE {
-      ?vac rdfs:subClassOf nuva:Vaccine .
-      ?vac skos:notation ?vacnot .
-      ?vac rdfs:label ?label filter(lang(?label)='en'||lang(?label)='') .
-      ?vac nuvs:isAbstract ?abstract .
-      """
-    if not fullset:
-      q1 += """
-      ?vac nuvs:isAbstract true
-      """                
-    q1 += """        
-    } ORDER BY ?vacnot
-    """
-    res1 = g.query(q1)
-    
-    bestcodes = {}
-    revcodes = {}
-    nbequiv = {}
+class LabelIndex:
+    # Memory-mapped label index built by build_label_index.
+    # search() matches every word of the query as a word prefix, ranking labels starting with the
+    # query first, then falls back to trigram similarity for misspelt queries.
+    def __init__(self, folder="nuva_search"):
+        with open(folder+"/search.json",encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+        self.codes = meta['codes']
+        self.langs = meta['langs']
+        self.labels = load_strings(folder+"/labels")
+        self.label_code = mapped(folder+"/label_code.npy")
+        self.label_lang = mapped(folder+"/label_lang.npy")
+        self.label_grams = mapped(folder+"/label_grams.npy")
+        self.label_length = mapped(folder+"/label_length.npy")
+        self.words = load_strings(folder+"/words")
+        self.word_label = mapped(folder+"/word_label.npy")
+        self.grams = load_strings(folder+"/grams")
+        self.gram_offsets = mapped(folder+"/gram_offsets.npy")
+        self.gram_label = mapped(folder+"/gram_label.npy")
 
-    for row in res1:
-        bestcodes[str(row.vacnot)] = {'label':str(row.label),'cardinality':10000,'isAbstract':str(row.abstract), 'codes':[]}
-        
-    nbnuva = len(bestcodes)
+    def search(self, query, limit=10, lang=None):
+        text = fold(query)
+        if not text: return []
+        found = None
+        for word in text.split():
+            lo,hi = self.words.prefixed(word)
+            matches = distinct(self.word_label[lo:hi])
+            found = matches if found is None else np.intersect1d(found,matches,assume_unique=True)
+            if not len(found): break
+        # Labels are sorted, so those starting with the text are one range
+        lo,hi = self.labels.prefixed(text)
+        inside = (found >= lo) & (found < hi)
+        ranked = found[np.lexsort((found,self.label_length[found],~inside))]
+        results = self.notations(ranked,limit,lang)
+        if len(results) < limit:
+            for code in self.notations(self.fuzzy(text),limit,lang):
+                if code not in results: results.append(code)
+                if len(results) == limit: break
+        return results
 
-    #if fullset:
-    print("Retrieve NUVA codes matching specific external codes")    
-    q2="""
-    SELECT ?extnot ?rlabel ?rnot ?abstract WHERE { 
-    ?extcode rdfs:subClassOf nuva:"""+code+""" .
+    def fuzzy(self, text):
+        # Labels sharing trigrams with the text, by decreasing Jaccard similarity
+        grams = trigrams(text)
+        postings = []
+        for gram in grams:
+            i = bisect.bisect_left(self.grams,gram)
+            if i < len(self.grams) and self.grams[i] == gram:
+                postings.append(self.gram_label[self.gram_offsets[i]:self.gram_offsets[i+1]])
+        if not postings: return np.zeros(0,dtype=np.int32)
+        shared = np.bincount(np.concatenate(postings),minlength=len(self.labels))
+        labels = np.flatnonzero(shared)
+        shared = shared[labels]
+        similarity = shared/(len(grams)+self.label_grams[labels]-shared)
+        keep = similarity >= 0.3
+        labels,similarity = labels[keep],similarity[keep]
+        return labels[np.argsort(-similarity,kind="stable")]
+
+    def notations(self, labels, limit, lang):
+        if lang is not None:
+            labels = labels[self.label_lang[labels] == (self.langs.index(lang) if lang in self.langs else -1)]
+        results = []
+        for code in self.label_code[labels].tolist():
+            code = self.codes[code]
+            if code not in results:
+                results.append(code)
+                if len(results) == limit: break
+        return results
+
+def valence_index(g):
+    # Valences of each vaccine and rdfs:subClassOf* closure of valences, computed once
+    # Each node of the closure gets a bit, so that valence sets become integer masks
+    NUVS = Namespace("http://ivci.org/NUVA/nuvs#")
+    VaccinesParent=URIRef(BaseURI+"Vaccine")
+
+    parents = {}
+    for s,o in g.subject_objects(RDFS.subClassOf):
+        parents.setdefault(s,[]).append(o)
+
+    bits = {}
+    closure = {}
+    def ancestors(node):
+        if node in closure: return closure[node]
+        closure[node] = mask = 1 << bits.setdefault(node,len(bits))
+        for parent in parents.get(node,[]):
+            mask |= ancestors(parent)
+        closure[node] = mask
+        return mask
+
+    vaccines = {}
+    for vac in g.subjects(RDFS.subClassOf,VaccinesParent):
+        valences = list(g.objects(vac,NUVS.containsValence))
+        down = [ancestors(val) for val in valences]
+        up = 0
+        for mask in down: up |= mask
+        own = 0
+        for val in valences: own |= 1 << bits[val]
+        vaccines[vac] = {'notations': sorted(str(n) for n in g.objects(vac,SKOS.notation)),
+                         'labels': [str(l) for l in g.objects(vac,RDFS.label)],
+                         'isAbstract': [str(a) for a in g.objects(vac,NUVS.isAbstract)],
+                         'abstract': (vac,NUVS.isAbstract,Literal(True)) in g,
+                         'own': own, 'up': up, 'down': down}
+    return vaccines
+
+def covers(ref,vac):
+    # Every valence of the reference has a descendant (or itself) in the candidate
+    if ref['own'] & ~vac['up']: return False
+    # Every valence of the candidate has an ancestor (or itself) in the reference
+    for mask in vac['down']:
+        if not mask & ref['own']: return False
+    return True
+
+# Queries are constant texts, with ?system bound to the code system class and, in q1, ?abstract
+# bound to true for generic vaccines only. Oxigraph only binds variables of the projection.
+
+abstract_refs_query="""
+    SELECT ?system ?extnot ?rlabel ?rnot ?rvac WHERE {
+    ?extcode rdfs:subClassOf ?system .
     ?extcode skos:notation ?extnot .
-    ?rvac rdfs:subClassOf nuva:Vaccine . 
-    ?rvac rdfs:label ?rlabel .
+    ?rvac rdfs:subClassOf nuva:Vaccine .
     ?rvac skos:exactMatch ?extcode .
     ?rvac skos:notation ?rnot .
-    ?rvac nuvs:isAbstract ?abstract .
-    } 
+    ?rvac rdfs:label ?rlabel .
+    ?rvac nuvs:isAbstract true .
+    }
     """
-    res2 = g.query(q2)
-    for row in res2:
-        extnot = code+"-"+str(row.extnot)
-        nuva_code = str(row.rnot)
-        if nuva_code in nbequiv:
-            nbequiv[nuva_code] += 1
-        else:
-            nbequiv[nuva_code] =1
-            
-        if (fullset and str(row.abstract)=='false'):
-            revcodes[extnot]= {"label" : str(row.rlabel), "cardinality" : 1, "may": [nuva_code], "blur":0, "best": []}
-            bestcodes[nuva_code]['cardinality'] = 1
-            bestcodes[nuva_code]['codes'].append(extnot)
 
+def abstract_refs(g,code):
+    # Abstract NUVA vaccines bound to the external codes, i.e. the references of q3
+    return [((str(row.extnot),str(row.rlabel),str(row.rnot)),row.rvac)
+            for row in g.query(abstract_refs_query,initBindings={'system': URIRef(BaseURI+code)})]
 
-    print("Retrieve NUVA codes matching abstract external codes")    
-    q3="""
-   SELECT ?extnot ?rlabel ?rnot (count(?codevac) as ?nvac) (GROUP_CONCAT(?vacnot) as ?lvac) WHERE { 
-   ?extcode rdfs:subClassOf nuva:"""+code+""" .
+def candidate_vaccines(index,fullset):
+    return [vac for vac in sorted(index, key=lambda v: index[v]['notations'])
+            if fullset or index[vac]['abstract']]
+
+def match_abstract(refs,fullset,index):
+    candidates = candidate_vaccines(index,fullset)
+    groups = {}
+    for key,rvac in refs:
+        ref = index[rvac]
+        matches = groups.setdefault(key,[])
+        for vac in candidates:
+            if covers(ref,index[vac]):
+                matches.extend(index[vac]['notations'])
+    return [key+(matches,) for key,matches in groups.items() if matches]
+
+def mask_rows(masks,width):
+    # Unpack integer bitmasks into the rows of a boolean matrix
+    nbytes = (width+7)//8
+    packed = np.frombuffer(b''.join(m.to_bytes(nbytes,'little') for m in masks),dtype=np.uint8)
+    return np.unpackbits(packed.reshape(len(masks),nbytes),axis=1,bitorder='little')[:,:width].astype(np.float32)
+
+def valence_matrix(index,fullset):
+    # Candidate vaccines as rows of matrices over the closure-expanded valences
+    candidates = candidate_vaccines(index,fullset)
+    width = 1
+    for vac in index:
+        for mask in index[vac]['down']: width = max(width,mask.bit_length())
+    valences = sorted({mask for vac in candidates for mask in index[vac]['down']})
+    column = {mask:i for i,mask in enumerate(valences)}
+    contains = np.zeros((len(candidates),len(valences)),dtype=np.float32)
+    for i,vac in enumerate(candidates):
+        for mask in index[vac]['down']: contains[i,column[mask]] = 1
+    return {'index': index, 'width': width,
+            'notations': [index[vac]['notations'] for vac in candidates],
+            'weight': np.array([len(index[vac]['notations']) for vac in candidates],dtype=np.float32),
+            'outside': 1-mask_rows([index[vac]['up'] for vac in candidates],width),
+            'ancestors': mask_rows(valences,width),
+            'contains': contains}
+
+def match_matrix(refs,fullset,matrix):
+    if not refs or not len(matrix['notations']): return []
+    own = mask_rows([matrix['index'][rvac]['own'] for key,rvac in refs],matrix['width'])
+    # Reference valences with no descendant in the candidate (refs x candidates)
+    uncovered = own @ matrix['outside'].T
+    # Candidate valences with no ancestor in the reference (candidates x refs)
+    reached = (matrix['ancestors'] @ own.T) > 0
+    foreign = matrix['contains'] @ (~reached).astype(np.float32)
+    match = (uncovered == 0) & (foreign.T == 0)
+    cardinality = match.astype(np.float32) @ matrix['weight']
+
+    groups = {}
+    for r,(key,rvac) in enumerate(refs):
+        matches = groups.setdefault(key,[])
+        if cardinality[r] == 0: continue
+        for c in np.flatnonzero(match[r]):
+            matches.extend(matrix['notations'][c])
+    return [key+(matches,) for key,matches in groups.items() if matches]
+
+query_abstract_query="""
+   SELECT ?system ?extnot ?rlabel ?rnot (count(?codevac) as ?nvac) (GROUP_CONCAT(?vacnot) as ?lvac) WHERE {
+   ?extcode rdfs:subClassOf ?system .
    ?extcode skos:notation ?extnot .
-   ?rvac rdfs:subClassOf nuva:Vaccine . 
+   ?rvac rdfs:subClassOf nuva:Vaccine .
    ?rvac skos:exactMatch ?extcode .
    ?rvac skos:notation ?rnot .
    ?rvac rdfs:label ?rlabel .
    ?rvac nuvs:isAbstract true .
    ?vac rdfs:subClassOf nuva:Vaccine .
-   """
-    if not fullset:
-       q3+= """?vac nuvs:isAbstract true .
-       """
-    q3+= """
+   %s
    ?vac skos:notation ?vacnot
     FILTER NOT EXISTS {
     # The reference vaccine ?rvac for the external code does not have any valence not within the ?vac candidate
@@ -278,101 +1207,1076 @@ def eval_code(code,fullset):
             ?val rdfs:subClassOf* ?rval
         }
     }
- } GROUP BY ?extnot ?rlabel ?rnot ?abstract
+ } GROUP BY ?system ?extnot ?rlabel ?rnot ?abstract
    """
-    res3=g.query(q3)
+# Generic vaccines only, or all of them
+query_abstract_queries = {False: query_abstract_query % "?vac nuvs:isAbstract true .", True: query_abstract_query % ""}
+
+def query_abstract(g,code,fullset):
+    return [(str(row.extnot),str(row.rlabel),str(row.rnot),row.lvac.split())
+            for row in g.query(query_abstract_queries[fullset],initBindings={'system': URIRef(BaseURI+code)})]
+
+def read_mappings(csv_fname):
+    # Mapping CSV as its code system and a list of (external code, NUVA code) rows
+    csv_file = open(csv_fname,'r',encoding="utf-8-sig",newline='')
+    code,rows = parse_mappings(csv_file)
+    csv_file.close()
+    return code,rows
+
+def parse_mappings(lines):
+    reader = csv.DictReader(lines,delimiter=';')
+    code = reader.fieldnames[0]
+    rows = [(row[code],row["NUVA"]) for row in reader]
+    return code,rows
 
-    for row in res3:
-        extnot = code+"-"+str(row.extnot)
-        rnot = str(row.rnot)
-        
-        nuva_codes=row.lvac.split()
+def add_mappings(g,overlay,code,rows,declare=False,log=print):
+    # Add the mappings of the core graph g to the overlay
+    add = overlay.add
+
+    codeParent=URIRef(BaseURI+code)
+    if declare and ((codeParent,None,None) not in g):
+        add((codeParent,RDFS.Class,OWL.Class))
+        add((codeParent,RDFS.subClassOf,URIRef(BaseURI+'Code')))
+        add((codeParent,RDFS.label,Literal(code)))
+
+    for extcode,nuva in rows:
+        codeURI=URIRef(BaseURI+extcode)
+        nuvaURI=URIRef(BaseURI+nuva)
+        if ((nuvaURI,None,None) not in g):
+            log ("Mapping to unknown NUVA code "+nuva)            
+
+        codeValue=extcode.rsplit('-')[1]
+
+        add((nuvaURI,SKOS.exactMatch,codeURI))
+        add((codeURI,RDFS.Class,OWL.Class))
+        add((codeURI,RDFS.subClassOf,codeParent))
+        add((codeURI,SKOS.notation,Literal(codeValue)))
+        add((codeURI,RDFS.label,Literal(extcode)))
+
+query_nuva_query="""
+    SELECT ?vacnot ?label ?abstract WHERE {
+      ?vac rdfs:subClassOf nuva:Vaccine .
+      ?vac skos:notation ?vacnot .
+      ?vac rdfs:label ?label filter(lang(?label)='en'||lang(?label)='') .
+      ?vac nuvs:isAbstract ?abstract .
+    } ORDER BY ?vacnot
+    """
+
+def query_nuva(g,fullset):
+    bindings = {} if fullset else {'abstract': Literal(True)}
+    return [(str(row.vacnot),str(row.label),str(row.abstract)) for row in g.query(query_nuva_query,initBindings=bindings)]
+
+query_specific_query="""
+    SELECT ?system ?extnot ?rlabel ?rnot ?abstract WHERE { 
+    ?extcode rdfs:subClassOf ?system .
+    ?extcode skos:notation ?extnot .
+    ?rvac rdfs:subClassOf nuva:Vaccine . 
+    ?rvac rdfs:label ?rlabel .
+    ?rvac skos:exactMatch ?extcode .
+    ?rvac skos:notation ?rnot .
+    ?rvac nuvs:isAbstract ?abstract .
+    } 
+    """
+
+def query_specific(g,code):
+    return [(str(row.extnot),str(row.rlabel),str(row.rnot),str(row.abstract))
+            for row in g.query(query_specific_query,initBindings={'system': URIRef(BaseURI+code)})]
+
+class QueryCache:
+    # LRU of query results, keyed by (query, core version, mapping fingerprint, code, fullset)
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits+self.misses
+            return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits/lookups if lookups else 0}
+
+query_cache = QueryCache()
+
+def mapping_fingerprint(rows):
+    return hashlib.sha256("\n".join(extcode+";"+nuva for extcode,nuva in rows).encode("utf-8")).hexdigest()
+
+class Best:
+    # Best external codes of a NUVA concept
+    __slots__ = ("label","isAbstract","cardinality","codes")
+    def __init__(self, label, isAbstract):
+        self.label = label
+        self.isAbstract = isAbstract
+        self.cardinality = 10000
+        self.codes = []
+
+class Reverse:
+    # NUVA concepts an external code may stand for, and those it is the best code for
+    __slots__ = ("label","cardinality","may","blur","best")
+    def __init__(self, label, cardinality, may):
+        self.label = label
+        self.cardinality = cardinality
+        self.may = may
+        self.blur = 0
+        self.best = []
+
+def record_dict(record):
+    return {slot:getattr(record,slot) for slot in record.__slots__}
+
+def best_reverse(code,fullset,res1,res2,res3):
+    # Solutions are taken in one order whatever the engine or the order of the mapping rows,
+    # so that every evaluation path writes the same reports
+    res2 = sorted(res2)
+    res3 = sorted(res3, key=lambda row: row[:3])
+    bestcodes = {}
+    revcodes = {}
+    nbequiv = {}
+
+    for (vacnot,label,abstract) in res1:
+        bestcodes[vacnot] = Best(label,abstract)
+
+    for (extvalue,rlabel,nuva_code,abstract) in res2:
+        extnot = code+"-"+extvalue
+        if nuva_code in nbequiv:
+            nbequiv[nuva_code] += 1
+        else:
+            nbequiv[nuva_code] =1
+            
+        if (fullset and abstract=='false'):
+            revcodes[extnot]= Reverse(rlabel,1,[nuva_code])
+            bestcodes[nuva_code].cardinality = 1
+            bestcodes[nuva_code].codes.append(extnot)
+
+    for (extvalue,rlabel,rnot,nuva_codes) in res3:
+        extnot = code+"-"+extvalue
          
         rcard = len(nuva_codes)                  
-        revcodes[extnot]= {"label" : str(row.rlabel), "cardinality" : rcard, "may": [], "blur":0, "best": []}
+        revcodes[extnot]= Reverse(rlabel,rcard,[])
 
-        for nuva_code in nuva_codes:
-            revcodes[extnot]['may'].append(nuva_code)
-            if (bestcodes[nuva_code]['cardinality'] == rcard):
-                bestcodes[nuva_code]['codes'].append(extnot)
+        for nuva_code in sorted(nuva_codes):
+            revcodes[extnot].may.append(nuva_code)
+            if (bestcodes[nuva_code].cardinality == rcard):
+                bestcodes[nuva_code].codes.append(extnot)
                 continue
-            if (bestcodes[nuva_code]['cardinality'] > rcard):
-                bestcodes[nuva_code]['cardinality'] = rcard
-                bestcodes[nuva_code]['codes']=[extnot]
+            if (bestcodes[nuva_code].cardinality > rcard):
+                bestcodes[nuva_code].cardinality = rcard
+                bestcodes[nuva_code].codes=[extnot]
+    return bestcodes,dict(sorted(revcodes.items())),nbequiv
 
+class Profile:
+    # Wall time, CPU time, peak RSS and solution count of each phase of an evaluation.
+    # The optional callback receives every phase record as soon as the phase ends.
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases = []
+        self.start = (time.perf_counter(),time.process_time())
 
-    print ("Create best codes report "+best_fname)
-    best_file = open(best_fname,'w',encoding="utf-8",newline='')
-    best_writer = csv.writer(best_file, delimiter=';')
-    best_writer.writerow(["NUVA","Label","IsAbstract", "Cardinality","Best "+code])
+    @contextmanager
+    def phase(self, name):
+        record = {'phase': name, 'rows': None}
+        wall,cpu = time.perf_counter(),time.process_time()
+        yield record
+        record['wall'] = time.perf_counter()-wall
+        record['cpu'] = time.process_time()-cpu
+        record['peak_rss'] = peak_rss()
+        self.phases.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def save(self, fname, **info):
+        with open(fname,'w',encoding="utf-8") as profile_file:
+            json.dump({**info, 'wall': time.perf_counter()-self.start[0], 'cpu': time.process_time()-self.start[1],
+                       'peak_rss': peak_rss(), 'phases': self.phases}, profile_file, indent=2)
+
+def peak_rss():
+    # In bytes, None where the resource module is missing (Windows)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+def score(bestcodes,revcodes,nbequiv):
+    # Fills the blur and best codes of the reverse codes, and returns the metrics of the evaluation
+    nbnuva = len(bestcodes)
     unmapped = 0
-    totalcount = 0
     nuva_equiv = total_equiv = 0
     for nuva_code in bestcodes:
-        best_writer.writerow([nuva_code,bestcodes[nuva_code]['label'],bestcodes[nuva_code]['isAbstract'],
-                              bestcodes[nuva_code]['cardinality'], bestcodes[nuva_code]['codes']])
-        if bestcodes[nuva_code]['cardinality'] ==  10000 :  unmapped +=1
+        if bestcodes[nuva_code].cardinality ==  10000 :  unmapped +=1
         else:
-            for extcode in bestcodes[nuva_code]['codes']:
-                revcodes[extcode]['blur'] +=1
-                revcodes[extcode]['best'].append(nuva_code)
+            for extcode in bestcodes[nuva_code].codes:
+                revcodes[extcode].blur +=1
+                revcodes[extcode].best.append(nuva_code)
         if nuva_code in nbequiv and nbequiv[nuva_code] != 0:
             nuva_equiv += 1
             total_equiv += nbequiv[nuva_code]
-    best_file.close
-
-    print ("Create reverse codes report "+rev_fname)
-    rev_file = open(rev_fname,'w',encoding="utf-8",newline='')
-    rev_writer = csv.writer(rev_file, delimiter=';')
-    rev_writer.writerow([code,"Label","Cardinality","May code", "Blur", "Best code for"])
 
     totalblur = 0
     for extcode in revcodes:
-        rev_writer.writerow([extcode,revcodes[extcode]['label'], 
-                             revcodes[extcode]['cardinality'],revcodes[extcode]['may'], 
-                             revcodes[extcode]['blur'], revcodes[extcode]['best']])
-        totalblur += revcodes[extcode]['blur']
-    rev_file.close
+        totalblur += revcodes[extcode].blur
 
     # All aligned codes, abstract or not, are now in rev_codes
     nbcodes = len(revcodes)
 
-
-
     completeness = (nbnuva-unmapped)/nbnuva
-    precision = nbcodes/totalblur
+    precision = 0
+    if totalblur != 0:
+        precision = nbcodes/totalblur
     redundancy = 0
     if nuva_equiv != 0:
         redundancy = total_equiv/nuva_equiv
+    blur = 0
+    if precision != 0:
+        blur = 1/precision
 
-    print ("Create metrics report "+metrics_fname)
-    metrics_file = open(metrics_fname,'w',encoding="utf-8",newline='')
-    print (f"NUVA version :{g.value(URIRef('http://ivci.org/NUVA'),OWL.versionInfo)}\n", file=metrics_file)
-    print (f"Number of NUVA concepts : {nbnuva}",file=metrics_file)
-    print (f"Number of unmapped concepts: {unmapped}",file=metrics_file)
-    print ("Completeness: {:.1%}\n".format(completeness),file=metrics_file)
-    print (f"Number of aligned codes: {nbcodes}",file=metrics_file)
-    print ("Average blur of aligned codes {:.1f}".format(1/precision),file=metrics_file)
-    print ("Precision: {:.1%}".format(precision),file=metrics_file)
-    print ("Redundancy: {:.3}".format(redundancy),file=metrics_file)
-    metrics_file.close()
+    return {'concepts': nbnuva, 'unmapped': unmapped, 'completeness': completeness, 'aligned': nbcodes,
+            'blur': blur, 'precision': precision, 'redundancy': redundancy}
 
-# Here the main program - Adapt the work directory to your environment
+def write_reports(code,fullset,bestcodes,revcodes,nbequiv,version,folder="",log=print,profile=None):
+    if fullset:
+        suffix="_full"
+    else:
+        suffix="_gen"
+    rev_fname = folder+"nuva_reverse_"+code+suffix+".csv"
+    best_fname=folder+"nuva_best_"+code+suffix+".csv"
+    metrics_fname = folder+"nuva_metrics_"+code+suffix+".txt"
+    profile = profile or Profile()
+    with profile.phase("score"):
+        metrics = {'code': code, 'mode': suffix[1:], 'version': version, **score(bestcodes,revcodes,nbequiv)}
+
+    log ("Create best codes report "+best_fname)
+    with profile.phase("write_best") as record:
+        best_file = open(best_fname,'w',encoding="utf-8",newline='')
+        best_writer = csv.writer(best_file, delimiter=';')
+        best_writer.writerow(["NUVA","Label","IsAbstract", "Cardinality","Best "+code])
+        for nuva_code in bestcodes:
+            best_writer.writerow([nuva_code,bestcodes[nuva_code].label,bestcodes[nuva_code].isAbstract,
+                                  bestcodes[nuva_code].cardinality, bestcodes[nuva_code].codes])
+        best_file.close()
+        record['rows'] = len(bestcodes)
+
+    log ("Create reverse codes report "+rev_fname)
+    with profile.phase("write_reverse") as record:
+        rev_file = open(rev_fname,'w',encoding="utf-8",newline='')
+        rev_writer = csv.writer(rev_file, delimiter=';')
+        rev_writer.writerow([code,"Label","Cardinality","May code", "Blur", "Best code for"])
+        for extcode in revcodes:
+            rev_writer.writerow([extcode,revcodes[extcode].label, 
+                                 revcodes[extcode].cardinality,revcodes[extcode].may, 
+                                 revcodes[extcode].blur, revcodes[extcode].best])
+        rev_file.close()
+        record['rows'] = len(revcodes)
+
+    log ("Create metrics report "+metrics_fname)
+    with profile.phase("write_metrics"):
+        metrics_file = open(metrics_fname,'w',encoding="utf-8",newline='')
+        print (f"NUVA version :{version}\n", file=metrics_file)
+        print (f"Number of NUVA concepts : {metrics['concepts']}",file=metrics_file)
+        print (f"Number of unmapped concepts: {metrics['unmapped']}",file=metrics_file)
+        print ("Completeness: {:.1%}\n".format(metrics['completeness']),file=metrics_file)
+        print (f"Number of aligned codes: {metrics['aligned']}",file=metrics_file)
+        print ("Average blur of aligned codes {:.1f}".format(metrics['blur']),file=metrics_file)
+        print ("Precision: {:.1%}".format(metrics['precision']),file=metrics_file)
+        print ("Redundancy: {:.3}".format(metrics['redundancy']),file=metrics_file)
+        metrics_file.close()
+
+    return metrics
+
+def eval_code(code,fullset,engine="matrix",version=None,callback=None):
+    # The phases are profiled in nuva_profile_<code>_<mode>.json, and passed to callback if given
+    csv_fname = "nuva_refcode_"+code+".csv"
+    profile = Profile(callback)
+    print ("Loading core graph")
+    with profile.phase("load_core"):
+        g,store,key = open_core(core_fname,version)
+
+    print ("Loading code graph")
+    with profile.phase("read_mappings") as record:
+        code,rows = read_mappings(csv_fname)
+        record['rows'] = len(rows)
+
+    codeParent=URIRef(BaseURI+code)
+    if ((codeParent,None,None) not in g):
+        print ("Unknown CodeSystem "+code)
+        # Ajouter ici la création du code parent
+        g.close()
+        return
+
+    # Results are reused from the query cache when the same mappings were evaluated on this core content
+    version = core_version(g)
+    fingerprint = mapping_fingerprint(rows)
+    if engine == "matrix" and np is None:
+        engine = "index"
+    res1 = query_cache.get(("q1",key,None,None,fullset))
+    res2 = query_cache.get(("q2",key,fingerprint,code,None))
+    res3 = query_cache.get(("q3_"+engine,key,fingerprint,code,fullset))
+
+    # Mappings go to an overlay dropped once the evaluation is done
+    overlay = None
+    if res2 is None or res3 is None:
+        overlay = Overlay(g,store)
+        with profile.phase("add_mappings") as record:
+            add_mappings(g,overlay,code,rows)
+            record['rows'] = len(overlay)
+
+    # Queries are fully iterated within their phase
+    print ("Retrieve the list of NUVA codes")
+    with profile.phase("q1") as record:
+        if res1 is None:
+            res1 = query_cache.put(("q1",key,None,None,fullset),query_nuva(g,fullset))
+        record['rows'] = len(res1)
+
+    print("Retrieve NUVA codes matching specific external codes")    
+    with profile.phase("q2") as record:
+        if res2 is None:
+            res2 = query_cache.put(("q2",key,fingerprint,code,None),query_specific(overlay,code))
+        record['rows'] = len(res2)
+
+    print("Retrieve NUVA codes matching abstract external codes")    
+    with profile.phase("q3_"+engine) as record:
+        if res3 is None:
+            if engine == "sparql":
+                res3 = query_abstract(overlay,code,fullset)
+            elif engine == "matrix":
+                res3 = match_matrix(abstract_refs(overlay,code),fullset,valence_matrix(valence_index(g),fullset))
+            else:
+                res3 = match_abstract(abstract_refs(overlay,code),fullset,valence_index(g))
+            query_cache.put(("q3_"+engine,key,fingerprint,code,fullset),res3)
+        record['rows'] = len(res3)
 
-os.chdir(str(Path.home())+"/Documents/NUVA")
-#get_nuva(get_nuva_version())
-#split_nuva()
-#core_to_csv()
-#refturtle_to_map("CVX")
-#shutil.copyfile("nuva_refcode_CVX.csv","nuva_code_CVX.csv")
-#map_to_turtle("CVX")
-eval_code("CVX",False) # Assess CVX against generic NUVA codes
-#eval_code("CVX",True)  # Assess CVX against all NUVA codes
-#eval_code("ATC",False)
-#eval_code("ATC",True)
-#eval_code("CIS",True)
-#eval_code("CVC", False)
-#eval_code("CVC", True)
-#eval_code("CNK", True)
-#eval_code("SNOMED-CT", True)
+    with profile.phase("best_reverse") as record:
+        bestcodes,revcodes,nbequiv = best_reverse(code,fullset,res1,res2,res3)
+        record['rows'] = len(bestcodes)+len(revcodes)
+    metrics = write_reports(code,fullset,bestcodes,revcodes,nbequiv,version,profile=profile)
+
+    if overlay is not None:
+        overlay.drop()
+    g.close()
+    cache = query_cache.stats()
+    print (f"Query cache: {cache['entries']}/{cache['size']} entries, hit rate {cache['hit_rate']:.0%}")
+    profile_fname = "nuva_profile_"+code+"_"+metrics['mode']+".json"
+    print ("Create run profile "+profile_fname)
+    profile.save(profile_fname,code=code,mode=metrics['mode'],engine=engine,version=version,cache=cache)
+    return metrics
+
+def core_tables(g,key):
+    # Everything an evaluation needs from the core, computed once and shared.
+    # key identifies the core content (see open_core), version is the release it declares.
+    index = valence_index(g)
+    tables = {'version': core_version(g), 'core': key, 'index': index,
+              'systems': {str(s) for s in g.subjects(RDFS.subClassOf,URIRef(BaseURI+"Code"))},
+              'nuva': {fullset: query_nuva(g,fullset) for fullset in (True,False)}}
+    if np is not None:
+        tables['matrix'] = {fullset: valence_matrix(index,fullset) for fullset in (True,False)}
+    return tables
+
+def mapping_rows(index,rows,log=print):
+    # Solutions of q2 and references of q3, taken from the mapping rows instead of the graph
+    specific = []
+    refs = []
+    seen = set()
+    for extcode,nuva in rows:
+        nuvaURI=URIRef(BaseURI+nuva)
+        if nuvaURI not in index:
+            log ("Mapping to unknown NUVA code "+nuva)
+            continue
+        if (extcode,nuvaURI) in seen: continue
+        seen.add((extcode,nuvaURI))
+        vac = index[nuvaURI]
+        extvalue = extcode.rsplit('-')[1]
+        for rnot in vac['notations']:
+            for rlabel in vac['labels']:
+                for abstract in vac['isAbstract']:
+                    specific.append((extvalue,rlabel,rnot,abstract))
+                if vac['abstract']:
+                    refs.append(((extvalue,rlabel,rnot),nuvaURI))
+    return specific,refs
+
+def evaluate(tables,code,rows,fullset,engine="matrix",log=print):
+    if engine == "matrix" and 'matrix' not in tables:
+        engine = "index"
+    key = ("rows_"+engine,tables['core'],mapping_fingerprint(rows),code,fullset)
+    cached = query_cache.get(key)
+    if cached is None:
+        specific,refs = mapping_rows(tables['index'],rows,log)
+        if engine == "matrix":
+            res3 = match_matrix(refs,fullset,tables['matrix'][fullset])
+        else:
+            res3 = match_abstract(refs,fullset,tables['index'])
+        cached = query_cache.put(key,(specific,res3))
+    specific,res3 = cached
+    return best_reverse(code,fullset,tables['nuva'][fullset],specific,res3)
+
+def eval_incremental(code,fullset,engine="matrix",version=None):
+    # Evaluation reusing the candidates of the previous run, kept in nuva_state_<code>_<mode>.json.
+    # Only the external codes whose mapping rows changed are matched again, then best and reverse
+    # codes are aggregated again from the candidates of all codes, as a run from scratch would do.
+    suffix = "_full" if fullset else "_gen"
+    state_fname = "nuva_state_"+code+suffix+".json"
+    code,rows = read_mappings("nuva_refcode_"+code+".csv")
+
+    # Rows are grouped as q3 groups them, on the value of the external code
+    groups = {}
+    for extcode,nuva in rows:
+        groups.setdefault(extcode.rsplit('-')[1],[]).append((extcode,nuva))
+
+    print ("Loading core graph")
+    g,store,key = open_core(core_fname,version)
+    if (URIRef(BaseURI+code),None,None) not in g:
+        print ("Unknown CodeSystem "+code)
+        g.close()
+        return
+    version = core_version(g)
+    if engine == "matrix" and np is None:
+        engine = "index"
+
+    # The state is only valid for the same core content, JSON lists are turned back into tuples
+    state = {'groups': {}, 'best': {}}
+    if os.path.exists(state_fname):
+        with open(state_fname,encoding="utf-8") as state_file:
+            previous = json.load(state_file)
+        if previous.get('core') == key and previous['engine'] == engine:
+            state = previous
+            for group in state['groups'].values():
+                for field in ('rows','specific','matches'):
+                    group[field] = [tuple(row) for row in group[field]]
+    changed = [extvalue for extvalue in groups if state['groups'].get(extvalue,{}).get('rows') != groups[extvalue]]
+    removed = [extvalue for extvalue in state['groups'] if extvalue not in groups]
+    print (f"{len(changed)} external codes to evaluate, {len(removed)} removed, {len(groups)-len(changed)} unchanged")
+
+    index = valence_index(g)
+    if changed and engine == "matrix":
+        matrix = valence_matrix(index,fullset)
+    for extvalue in changed:
+        specific,refs = mapping_rows(index,groups[extvalue])
+        if engine == "matrix":
+            matches = match_matrix(refs,fullset,matrix)
+        else:
+            matches = match_abstract(refs,fullset,index)
+        state['groups'][extvalue] = {'rows': groups[extvalue], 'specific': specific, 'matches': matches}
+    for extvalue in removed:
+        del state['groups'][extvalue]
+
+    res1 = query_nuva(g,fullset)
+    res2 = [row for extvalue in groups for row in state['groups'][extvalue]['specific']]
+    res3 = [row for extvalue in groups for row in state['groups'][extvalue]['matches']]
+    bestcodes,revcodes,nbequiv = best_reverse(code,fullset,res1,res2,res3)
+    best = {nuva_code:bestcodes[nuva_code].cardinality for nuva_code in bestcodes}
+    print (f"{sum(1 for nuva_code in best if state['best'].get(nuva_code) != best[nuva_code])} NUVA concepts changed")
+    metrics = write_reports(code,fullset,bestcodes,revcodes,nbequiv,version)
+    g.close()
+
+    state = {'core': key, 'version': version, 'engine': engine, 'groups': {extvalue:state['groups'][extvalue] for extvalue in groups},
+             'best': best}
+    print ("Save evaluation state "+state_fname)
+    with open(state_fname,'w',encoding="utf-8") as state_file:
+        json.dump(state,state_file)
+    return metrics
+
+def check_incremental(code,fullset,engine="matrix",edits=5,folder="nuva_check"):
+    # Evaluate incrementally, edit some mapping rows and evaluate again in folder, then compare
+    # the reports with those of a run from scratch
+    home = os.getcwd()
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    shutil.copyfile(core_fname,Path(folder,core_fname))
+    shutil.copyfile("nuva_refcode_"+code+".csv",Path(folder,"nuva_refcode_"+code+".csv"))
+    os.chdir(folder)
+    try:
+        suffix = "_full" if fullset else "_gen"
+        if os.path.exists("nuva_state_"+code+suffix+".json"):
+            os.remove("nuva_state_"+code+suffix+".json")
+        eval_incremental(code,fullset,engine)
+
+        # Some rows are mapped to the NUVA code of the last rows, the last row is removed
+        with open("nuva_refcode_"+code+".csv",encoding="utf-8-sig",newline='') as csv_file:
+            lines = list(csv.reader(csv_file,delimiter=';'))
+        column = lines[0].index("NUVA")
+        for i in range(1,min(edits+1,len(lines)-1)):
+            lines[i][column] = lines[-i][column]
+        with open("nuva_refcode_"+code+".csv",'w',encoding="utf-8",newline='') as csv_file:
+            csv.writer(csv_file,delimiter=';').writerows(lines[:-1])
+        eval_incremental(code,fullset,engine)
+
+        fnames = ["nuva_best_"+code+suffix+".csv","nuva_reverse_"+code+suffix+".csv","nuva_metrics_"+code+suffix+".txt"]
+        incremental = [Path(fname).read_bytes() for fname in fnames]
+        eval_code(code,fullset,engine)
+        different = [fname for fname,content in zip(fnames,incremental) if Path(fname).read_bytes() != content]
+    finally:
+        os.chdir(home)
+    if different:
+        print ("Incremental evaluation differs from a full one in "+", ".join(different))
+    else:
+        print ("Incremental evaluation matches a full one")
+    return not different
+
+batch_tables = None
+
+def set_batch_tables(tables):
+    global batch_tables
+    batch_tables = tables
+
+def eval_job(job):
+    code,fullset,engine = job
+    code,rows = read_mappings("nuva_refcode_"+code+".csv")
+    if BaseURI+code not in batch_tables['systems']:
+        print ("Unknown CodeSystem "+code)
+        return None
+    bestcodes,revcodes,nbequiv = evaluate(batch_tables,code,rows,fullset,engine)
+    return write_reports(code,fullset,bestcodes,revcodes,nbequiv,batch_tables['version'])
+
+def serve_job(job):
+    # Evaluation of one mapping submitted to the server, returned instead of written
+    code,rows,fullset,engine = job
+    start = time.perf_counter()
+    warnings = []
+    bestcodes,revcodes,nbequiv = evaluate(batch_tables,code,rows,fullset,engine,warnings.append)
+    metrics = score(bestcodes,revcodes,nbequiv)
+    return bestcodes,revcodes,metrics,warnings,time.perf_counter()-start
+
+def eval_batch(codes,modes=(False,True),workers=None,engine="matrix",version=None):
+    # Evaluate several code systems against one loaded core, spread over processes
+    print ("Loading core graph")
+    g,store,key = open_core(core_fname,version)
+    tables = core_tables(g,key)
+    g.close()
+
+    jobs = [(code,fullset,engine) for code in codes for fullset in modes]
+    if workers == 1:
+        set_batch_tables(tables)
+        results = list(map(eval_job,jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,initializer=set_batch_tables,initargs=(tables,)) as executor:
+            results = list(executor.map(eval_job,jobs))
+    summary = [metrics for metrics in results if metrics is not None]
+
+    print ("Create metrics summary "+metrics_summary_fname)
+    summary_file = open(metrics_summary_fname,'w',encoding="utf-8",newline='')
+    writer = csv.writer(summary_file, delimiter=';')
+    writer.writerow(["Code","Mode","Concepts","Unmapped","Completeness","Aligned codes","Average blur","Precision","Redundancy"])
+    for m in summary:
+        writer.writerow([m['code'],m['mode'],m['concepts'],m['unmapped'],"{:.1%}".format(m['completeness']),
+                         m['aligned'],"{:.1f}".format(m['blur']),"{:.1%}".format(m['precision']),"{:.3}".format(m['redundancy'])])
+    summary_file.close()
+    return summary
+
+def history_job(job):
+    # Metrics of the mappings against one NUVA release, split in its own folder if needed
+    version,folder,mappings,modes,engine,offline = job
+    home = os.getcwd()
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    os.chdir(folder)
+    try:
+        if not Path(full_fname).exists():
+            if offline:
+                print ("NUVA version "+version+" is not cached in "+folder)
+                return []
+            try:
+                get_nuva(version)
+            except OSError as e:
+                print ("Cannot retrieve NUVA version "+version+": "+str(e))
+                return []
+        if not Path(core_fname).exists() or Path(core_fname).stat().st_mtime < Path(full_fname).stat().st_mtime:
+            split_nuva(1)
+        g = Graph(store="Oxigraph")
+        g.bind("nuvs",Namespace("http://ivci.org/NUVA/nuvs#"))
+        g.bind("nuva",Namespace(BaseURI))
+        g.parse(core_fname,format="ox-turtle")
+        tables = core_tables(g,hashlib.sha256(Path(core_fname).read_bytes()).hexdigest())
+    finally:
+        os.chdir(home)
+    release = tables['version']
+
+    results = []
+    for csv_fname in mappings:
+        code,rows = read_mappings(csv_fname)
+        if BaseURI+code not in tables['systems']:
+            print ("Unknown CodeSystem "+code+" in NUVA version "+version)
+            continue
+        for fullset in modes:
+            bestcodes,revcodes,nbequiv = evaluate(tables,code,rows,fullset,engine)
+            results.append({'code': code, 'mode': "full" if fullset else "gen", 'version': version,
+                            'release': release, **score(bestcodes,revcodes,nbequiv)})
+    return results
+
+def eval_history(versions,mappings,releases="nuva_releases",modes=(False,True),workers=None,engine="matrix",offline=False):
+    # Metrics of the same mapping CSVs across NUVA versions, one version per process.
+    # Each release lives in releases/<version>/nuva_ivci.rdf, retrieved only when missing unless offline.
+    mappings = [str(Path(csv_fname).resolve()) for csv_fname in mappings]
+    jobs = [(version,str(Path(releases,version).resolve()),mappings,modes,engine,offline) for version in versions]
+    if workers == 1:
+        results = list(map(history_job,jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(history_job,jobs))
+
+    series = {}
+    for metrics in results:
+        for m in metrics:
+            series.setdefault(m['code'],[]).append(m)
+    for code,metrics in series.items():
+        history_fname = "nuva_history_"+code+".csv"
+        print ("Create metrics history "+history_fname)
+        history_file = open(history_fname,'w',encoding="utf-8",newline='')
+        writer = csv.writer(history_file, delimiter=';')
+        writer.writerow(["Version","Mode","Concepts","Unmapped","Completeness","Aligned codes","Average blur","Precision","Redundancy"])
+        for m in metrics:
+            writer.writerow([m['version'],m['mode'],m['concepts'],m['unmapped'],"{:.1%}".format(m['completeness']),
+                             m['aligned'],"{:.1f}".format(m['blur']),"{:.1%}".format(m['precision']),"{:.3}".format(m['redundancy'])])
+        history_file.close()
+    return series
+
+class TranslationIndex:
+    # In-memory translation between NUVA and external codes, in both directions.
+    # Built from the refcode CSVs of split_nuva, or from the best/reverse reports of eval_code
+    # when mode is "full" or "gen". External codes are looked up by code system and bare value.
+    def __init__(self, codes, mode=None):
+        self.nuva = {}
+        self.external = {}
+        self.cells = {}
+        for code in codes:
+            if mode is None:
+                self.load_mappings(code)
+            else:
+                self.load_reports(code,mode)
+        for code in self.nuva:
+            self.cells[code] = {value:" ".join(nuvas) for value,nuvas in self.nuva[code].items()}
+
+    def load_mappings(self, code):
+        code,rows = read_mappings("nuva_refcode_"+code+".csv")
+        to_nuva = {}
+        to_external = {}
+        for extcode,nuva in rows:
+            to_nuva.setdefault(extcode[len(code)+1:],[]).append(nuva)
+            to_external.setdefault(nuva,[]).append(extcode)
+        self.add(code,to_nuva,to_external)
+
+    def load_reports(self, code, mode):
+        to_nuva = {}
+        to_external = {}
+        best_file = open("nuva_best_"+code+"_"+mode+".csv",'r',encoding="utf-8",newline='')
+        reader = csv.reader(best_file,delimiter=';')
+        next(reader)
+        for row in reader:
+            extcodes = ast.literal_eval(row[4])
+            if extcodes: to_external[row[0]] = extcodes
+        best_file.close()
+        rev_file = open("nuva_reverse_"+code+"_"+mode+".csv",'r',encoding="utf-8",newline='')
+        reader = csv.reader(rev_file,delimiter=';')
+        next(reader)
+        for row in reader:
+            nuvas = ast.literal_eval(row[5])
+            if nuvas: to_nuva[row[0][len(code)+1:]] = nuvas
+        rev_file.close()
+        self.add(code,to_nuva,to_external)
+
+    def add(self, code, to_nuva, to_external):
+        self.nuva.setdefault(code,{}).update({value:tuple(nuvas) for value,nuvas in to_nuva.items()})
+        self.external.setdefault(code,{}).update({nuva:tuple(extcodes) for nuva,extcodes in to_external.items()})
+
+    def to_nuva(self, code, value):
+        return self.nuva[code].get(value,())
+
+    def to_external(self, nuva, code):
+        return self.external[code].get(nuva,())
+
+    def translate(self, values, code, batch_size=chunk_size):
+        # Yields the NUVA codes of the values batch by batch, as space separated strings
+        lookup = self.cells[code].get
+        batch = []
+        for value in values:
+            batch.append(value)
+            if len(batch) == batch_size:
+                yield [lookup(value,"") for value in batch]
+                batch = []
+        if batch:
+            yield [lookup(value,"") for value in batch]
+
+    def translate_csv(self, in_fname, out_fname, code, column, batch_size=chunk_size):
+        # Copies a CSV of records with an additional NUVA column, translated from the given column
+        start = time.perf_counter()
+        in_file = open(in_fname,'r',encoding="utf-8-sig",newline='')
+        out_file = open(out_fname,'w',encoding="utf-8",newline='')
+        reader = csv.reader(in_file,delimiter=';')
+        writer = csv.writer(out_file,delimiter=';')
+        header = next(reader)
+        writer.writerow(header+["NUVA"])
+        index = header.index(column)
+        lookup = self.cells[code].get
+        records = translated = 0
+        while True:
+            batch = list(itertools.islice(reader,batch_size))
+            if not batch: break
+            nuvas = [lookup(row[index],"") for row in batch]
+            writer.writerows(row+[nuva] for row,nuva in zip(batch,nuvas))
+            records += len(batch)
+            translated += len(batch)-nuvas.count("")
+        in_file.close()
+        out_file.close()
+        elapsed = time.perf_counter()-start
+        print (f"Translated {translated}/{records} {code} records in {elapsed:.2f}s ({records/elapsed:,.0f} records/s)")
+        return {'records': records, 'translated': translated, 'seconds': elapsed}
+
+def coverage_index(g,codes):
+    # Valences covered by each external code, through the vaccines it is bound to, their
+    # nuvs:containsValence and the rdfs:subClassOf ancestors of these valences.
+    # Covered valence sets are integer masks, one bit per valence notation.
+    NUVS = Namespace("http://ivci.org/NUVA/nuvs#")
+    ValencesParent = URIRef(BaseURI+"Valence")
+    parents = {}
+    for s,o in g.subject_objects(RDFS.subClassOf):
+        parents.setdefault(s,[]).append(o)
+
+    closure = {}
+    def ancestors(node):
+        if node not in closure:
+            closure[node] = set()
+            found = {node}
+            for parent in parents.get(node,[]):
+                if parent != ValencesParent: found |= ancestors(parent)
+            closure[node] = found
+        return closure[node]
+
+    contains = {}
+    for vac,val in g.subject_objects(NUVS.containsValence):
+        contains.setdefault(vac,set()).update(ancestors(val))
+    notation = {s:str(o) for s,o in g.subject_objects(SKOS.notation)}
+    valences = sorted({notation.get(val,val.split('/')[-1]) for vals in contains.values() for val in vals})
+    bits = {val:1 << i for i,val in enumerate(valences)}
+
+    vaccines = {}
+    masks = {}
+    valence_vaccines = {}
+    for vac,vals in contains.items():
+        mask = 0
+        for val in vals:
+            name = notation.get(val,val.split('/')[-1])
+            mask |= bits[name]
+            valence_vaccines.setdefault(name,[]).append(notation.get(vac))
+        vaccines[notation.get(vac)] = mask
+    for code in codes:
+        code,rows = read_mappings("nuva_refcode_"+code+".csv")
+        for extcode,nuva in rows:
+            masks[extcode] = masks.get(extcode,0) | vaccines.get(nuva,0)
+    return {'valences': valences, 'codes': masks, 'vaccines': vaccines,
+            'valence_vaccines': {val:sorted(vacs) for val,vacs in valence_vaccines.items()}}
+
+coverage = None
+
+def set_coverage(index):
+    global coverage
+    coverage = index
+
+def patient_batches(records,batch_size):
+    # Batches of (patient, code) records never splitting the records of one patient,
+    # which are expected to be contiguous as in an export sorted by patient
+    batch = []
+    for record in records:
+        if len(batch) >= batch_size and record[0] != batch[-1][0]:
+            yield batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch
+
+def resolve_batch(records):
+    # Covered valences of each patient of the batch, as space separated notations
+    masks = coverage['codes']
+    names = coverage['valences']
+    decoded = {0: ""}
+    results = []
+    unknown = 0
+    patient = None
+    mask = 0
+    for record in records:
+        if record[0] != patient:
+            if patient is not None: results.append((patient,mask))
+            patient,mask = record[0],0
+        code_mask = masks.get(record[1])
+        if code_mask is None: unknown += 1
+        else: mask |= code_mask
+    if patient is not None: results.append((patient,mask))
+
+    for i,(patient,mask) in enumerate(results):
+        if mask not in decoded:
+            decoded[mask] = " ".join(names[bit] for bit in range(mask.bit_length()) if mask >> bit & 1)
+        results[i] = (patient,decoded[mask])
+    return results,unknown
+
+class CoverageResolver:
+    # Valences each patient is covered against, given the external codes administered to them
+    def __init__(self, codes, version=None):
+        print ("Loading core graph")
+        g,store,key = open_core(core_fname,version)
+        self.index = coverage_index(g,codes)
+        g.close()
+        print (f"{len(self.index['codes'])} external codes over {len(self.index['valences'])} valences")
+
+    def valences(self, extcode):
+        mask = self.index['codes'].get(extcode,0)
+        return [name for bit,name in enumerate(self.index['valences']) if mask >> bit & 1]
+
+    def vaccines(self, valence):
+        return self.index['valence_vaccines'].get(valence,[])
+
+    def resolve(self, records, batch_size=chunk_size, workers=None):
+        # Yields lists of (patient, covered valences) for streams of (patient, code) records
+        self.stats = {'records': 0, 'patients': 0, 'unknown': 0, 'seconds': 0}
+        start = time.perf_counter()
+        def counted(batches):
+            for batch in batches:
+                self.stats['records'] += len(batch)
+                yield batch
+        batches = counted(patient_batches(records,batch_size))
+        if workers == 1:
+            set_coverage(self.index)
+            results = map(resolve_batch,batches)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers,initializer=set_coverage,initargs=(self.index,))
+            results = bounded_map(executor,resolve_batch,batches,2*(workers or os.cpu_count() or 1))
+        try:
+            for patients,unknown in results:
+                self.stats['patients'] += len(patients)
+                self.stats['unknown'] += unknown
+                yield patients
+        finally:
+            if executor is not None: executor.shutdown()
+            self.stats['seconds'] = time.perf_counter()-start
+
+    def resolve_csv(self, in_fname, out_fname, patient_column, code_column, batch_size=chunk_size, workers=None):
+        # Lines are parsed and written back by the workers, the reader only cuts them in batches.
+        # Records of one patient must be contiguous, and fields must not span several lines.
+        start = time.perf_counter()
+        in_file = open(in_fname,'r',encoding="utf-8-sig",newline='')
+        out_file = open(out_fname,'w',encoding="utf-8",newline='')
+        header = next(csv.reader([in_file.readline()],delimiter=';'))
+        patient,code = header.index(patient_column),header.index(code_column)
+        out_file.write(patient_column+";Valences\r\n")
+        jobs = ((lines,patient,code) for lines in line_batches(in_file,patient,batch_size))
+        stats = {'records': 0, 'patients': 0, 'unknown': 0}
+        if workers == 1:
+            set_coverage(self.index)
+            results = map(resolve_lines,jobs)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers,initializer=set_coverage,initargs=(self.index,))
+            results = bounded_map(executor,resolve_lines,jobs,2*(workers or os.cpu_count() or 1))
+        for text,records,patients,unknown in results:
+            out_file.write(text)
+            stats['records'] += records
+            stats['patients'] += patients
+            stats['unknown'] += unknown
+        if executor is not None: executor.shutdown()
+        in_file.close()
+        out_file.close()
+        stats['seconds'] = time.perf_counter()-start
+        print (f"Resolved {stats['patients']} patients from {stats['records']} records in {stats['seconds']:.2f}s "
+               f"({stats['records']/stats['seconds']:,.0f} records/s, {stats['unknown']} unknown codes)")
+        return stats
+
+def bounded_map(executor,function,jobs,window):
+    # Results in the order of the jobs, with at most window jobs in flight: executor.map
+    # would submit every job first, reading the whole input before the first result
+    pending = deque()
+    for job in jobs:
+        pending.append(executor.submit(function,job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def line_batches(lines,patient,batch_size):
+    # Batches of CSV lines, only cut where the patient changes
+    batch = []
+    last = None
+    for line in lines:
+        if len(batch) >= batch_size:
+            if last is None: last = next(csv.reader([batch[-1]],delimiter=';'))[patient]
+            if next(csv.reader([line],delimiter=';'))[patient] != last:
+                yield batch
+                batch = []
+                last = None
+        batch.append(line)
+    if batch:
+        yield batch
+
+def resolve_lines(job):
+    lines,patient,code = job
+    results,unknown = resolve_batch([(row[patient],row[code]) for row in csv.reader(lines,delimiter=';')])
+    text = io.StringIO()
+    csv.writer(text,delimiter=';').writerows(results)
+    return text.getvalue(),len(lines),len(results),unknown
+
+def crosswalk_job(code):
+    # Crosswalks from one code system to every other one. A source code reaches the target codes
+    # bound to its own NUVA concepts, and "may" reach those bound to the q3 candidates of its
+    # abstract concepts. Rows are sorted on the source id, so that a code is found by binary search.
+    index = batch_tables['index']
+    bindings = batch_tables['bindings']
+    ids = batch_tables['code_ids']
+    exact = {}
+    refs = []
+    for extcode,nuva in bindings[code]['rows']:
+        nuvaURI = URIRef(BaseURI+nuva)
+        if nuvaURI not in index: continue
+        exact.setdefault(extcode,set()).add(nuva)
+        if index[nuvaURI]['abstract']:
+            refs.append(((extcode,),nuvaURI))
+    if 'matrix' in batch_tables:
+        candidates = match_matrix(refs,True,batch_tables['matrix'][True])
+    else:
+        candidates = match_abstract(refs,True,index)
+    may = {extcode:set(matches)-exact[extcode] for extcode,matches in candidates}
+
+    folder = batch_tables['folder']+"/"+code
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    summary = []
+    for target,binding in bindings.items():
+        if target == code: continue
+        rows = []
+        for extcode,nuvas in exact.items():
+            reached = {t for nuva in nuvas for t in binding['nuva'].get(nuva,())}
+            possible = {t for nuva in may.get(extcode,()) for t in binding['nuva'].get(nuva,())}-reached
+            rows += [(ids[extcode],False,ids[t]) for t in reached]
+            rows += [(ids[extcode],True,ids[t]) for t in possible]
+        rows.sort()
+        cardinality = {}
+        ambiguity = {}
+        for source,flag,t in rows:
+            cardinality[source,flag] = cardinality.get((source,flag),0)+1
+            ambiguity[t,flag] = ambiguity.get((t,flag),0)+1
+        fname = folder+"/"+target
+        np.save(fname+".source.npy",np.array([r[0] for r in rows],dtype=np.int32))
+        np.save(fname+".may.npy",np.array([r[1] for r in rows],dtype=bool))
+        np.save(fname+".target.npy",np.array([r[2] for r in rows],dtype=np.int32))
+        np.save(fname+".cardinality.npy",np.array([cardinality[r[0],r[1]] for r in rows],dtype=np.int32))
+        np.save(fname+".ambiguity.npy",np.array([ambiguity[r[2],r[1]] for r in rows],dtype=np.int32))
+        exact_sources = {source for source,flag,t in rows if not flag}
+        summary.append((code,target,len(exact),len(exact_sources),
+                        len({source for source,flag,t in rows if flag}-exact_sources),
+                        sum(1 for (source,flag),n in cardinality.items() if not flag and n > 1),
+                        len(rows)))
+    return summary
+
+def build_crosswalks(codes=None,folder="nuva_crosswalk",workers=None,version=None):
+    # Every pairwise crosswalk between the code systems of the refcode CSVs, joined through NUVA,
+    # one process per source system. External codes are ids into one sorted string table.
+    if np is None:
+        print ("NumPy is not available, no crosswalks")
+        return
+    if codes is None:
+        codes = sorted(fname.stem[len("nuva_refcode_"):] for fname in Path(".").glob("nuva_refcode_*.csv"))
+    print ("Loading core graph")
+    g,store,key = open_core(core_fname,version)
+    tables = core_tables(g,key)
+    g.close()
+
+    bindings = {}
+    for code in codes:
+        code,rows = read_mappings("nuva_refcode_"+code+".csv")
+        to_external = {}
+        for extcode,nuva in rows:
+            to_external.setdefault(nuva,[]).append(extcode)
+        bindings[code] = {'rows': rows, 'nuva': to_external}
+    extcodes = sorted({extcode for binding in bindings.values() for extcode,nuva in binding['rows']})
+    Path(folder).mkdir(parents=True,exist_ok=True)
+    save_strings(folder+"/codes",extcodes)
+    tables.update(bindings=bindings,code_ids={extcode:i for i,extcode in enumerate(extcodes)},folder=folder)
+
+    if workers == 1:
+        set_batch_tables(tables)
+        results = list(map(crosswalk_job,bindings))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,initializer=set_batch_tables,initargs=(tables,)) as executor:
+            results = list(executor.map(crosswalk_job,bindings))
+    summary = [row for rows in results for row in rows]
+
+    summary_fname = "nuva_crosswalk_summary.csv"
+    print ("Create crosswalk summary "+summary_fname)
+    summary_file = open(summary_fname,'w',encoding="utf-8",newline='')
+    writer = csv.writer(summary_file, delimiter=';')
+    writer.writerow(["Source","Target","Codes","Mapped","May only","Ambiguous","Rows"])
+    writer.writerows(summary)
+    summary_file.close()
+    return summary
+
+class Crosswalk:
+    # Memory-mapped crosswalks built by build_crosswalks, loaded per pair on first use
+    def __init__(self, folder="nuva_crosswalk"):
+        self.folder = folder
+        self.codes = load_strings(folder+"/codes")
+        self.pairs = {}
+
+    def pair(self, source, target):
+        if (source,target) not in self.pairs:
+            fname = self.folder+"/"+source+"/"+target
+            self.pairs[source,target] = {column:mapped(fname+"."+column+".npy")
+                                         for column in ("source","may","target","cardinality","ambiguity")}
+        return self.pairs[source,target]
+
+    def translate(self, extcode, source, target):
+        # Target codes of a source code as (code, may, cardinality, ambiguity), exact ones first.
+        # Cardinality counts the targets of the source code, ambiguity the sources of the target code.
+        i = bisect.bisect_left(self.codes,extcode)
+        if i == len(self.codes) or self.codes[i] != extcode: return []
+        columns = self.pair(source,target)
+        lo,hi = np.searchsorted(columns['source'],[i,i+1])
+        return [(self.codes[t],may,cardinality,ambiguity) for t,may,cardinality,ambiguity in
+                zip(columns['target'][lo:hi].tolist(),columns['may'][lo:hi].tolist(),
+                    columns['cardinality'][lo:hi].tolist(),columns['ambiguity'][lo:hi].tolist())]
+
+# Here the main program - Adapt the work directory to your environment
 
+if __name__ == "__main__":
+    os.chdir(str(Path.home())+"/Documents/NUVA")
+    #get_nuva(get_nuva_version())
+    #split_nuva()
+    #load_partitions(["core","lang:fr","code:CVX"]) # Only these named graphs of nuva_bundle.nq
+    #core_to_csv()
+    #split_to_sqlite()                # Indexed tables for SQL point lookups
+    #lang_pivot(pairs=True)
+    #build_label_index()
+    #LabelIndex().search("hepatit")
+    #refturtle_to_map("CVX")
+    #shutil.copyfile("nuva_refcode_CVX.csv","nuva_code_CVX.csv")
+    #map_to_turtle("CVX")
+    eval_code("CVX",False) # Assess CVX against generic NUVA codes
+    #eval_code("CVX",True)  # Assess CVX against all NUVA codes
+    #eval_code("CVX",True,"sparql")  # Cross-check with the SPARQL query
+    #eval_code("CVX",True,"index")   # Cross-check with the pure Python engine
+    #eval_incremental("CVX",True)    # Only the changed mappings are evaluated again
+    #check_incremental("CVX",True)   # Edit some mappings and compare a rerun with a full evaluation
+    #eval_history(["2.0.0","2.1.0"],["nuva_refcode_CVX.csv","nuva_refcode_ATC.csv"],offline=True)
+    #eval_code("ATC",False)
+    #eval_code("ATC",True)
+    #eval_code("CIS",True)
+    #eval_code("CVC", False)
+    #eval_code("CVC", True)
+    #eval_code("CNK", True)
+    #eval_code("SNOMED-CT", True)
+    #eval_batch(["CVX","ATC","CIS","CVC","CNK","SNOMED-CT"]) # All code systems in both modes, one core load
+    #TranslationIndex(["CVX"]).translate_csv("immunizations.csv","immunizations_nuva.csv","CVX","CVX")
+    #build_crosswalks()              # All pairwise crosswalks of the refcode CSVs
+    #Crosswalk().translate("CVX-03","CVX","ATC")
+    #CoverageResolver(["CVX","ATC"]).resolve_csv("immunizations.csv","coverage.csv","Patient","Code")